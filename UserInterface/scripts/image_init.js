@@ -69,6 +69,33 @@ function enter_select_image_view (dir) {
 	$("#select-image-view").css("display", "flex");
 
 	var $div = $("#select-image-container");
+
+	// A participant written with --thumb-layout sprite has a sprite.json
+	// manifest; otherwise its thumbnails are listed in "Name of Images".
+	load_sprite_manifest(dir, function (manifest) {
+		if (manifest) {
+			append_sprite_tiles($div, dir, manifest);
+		} else {
+			append_image_files($div, dir);
+		}
+
+		$("#select-candidate-container > div > img").dblclick(function(){
+			enter_detail_image_view($(this).attr("file_name"), $(this).attr("img_type"), this.src);
+		});
+
+		$("#select-candidate-container > div > img").click(function(){
+			$("#exibit-img").attr("src", this.src)
+							.attr("img_type", $(this).attr("img_type"));
+		});
+
+		$("#exibit-img").click(function(){
+			enter_detail_image_view($(this).attr("file_name"), $(this).attr("img_type"), this.src);
+		});
+	});
+}
+
+
+function append_image_files ($div, dir) {
 	// image_name = image_names[0][1];
 	// console.log(image_names);
 
@@ -92,23 +119,45 @@ function enter_select_image_view (dir) {
 			}
 		}
 	}
-
-	
-
-	$div = $("#select-candidate-container");
+}
 
 
-	$("#select-candidate-container > div > img").dblclick(function(){
-		enter_detail_image_view($(this).attr("file_name"), $(this).attr("img_type"), this.src);
-	});
+function load_sprite_manifest (dir, callback) {
+	$.getJSON(DATA_PATH + dir + "/sprite.json")
+		.done(function (manifest) { callback(manifest); })
+		.fail(function () { callback(null); });
+}
 
-	$("#select-candidate-container > div > img").click(function(){
-		$("#exibit-img").attr("src", this.src)
-						.attr("img_type", $(this).attr("img_type"));
-	});
 
-	$("#exibit-img").click(function(){
-		enter_detail_image_view($(this).attr("file_name"), $(this).attr("img_type"), this.src);
+function append_sprite_tiles ($div, dir, manifest) {
+	// Load every sheet once, then crop each tile into its own canvas.
+	var sheets = [];
+	var loaded = 0;
+	manifest.sheets.forEach(function (sheet_name) {
+		var sheet = new Image();
+		sheet.onload = function () {
+			loaded += 1;
+			if (loaded < manifest.sheets.length) {
+				return;
+			}
+			// last slice first, as for the individual image files
+			var tiles = manifest.tiles.slice().reverse();
+			for (var i = 0; i < tiles.length; i++) {
+				var tile = tiles[i];
+				var canvas = document.createElement("canvas");
+				canvas.width = tile.width;
+				canvas.height = tile.height;
+				canvas.getContext("2d").drawImage(sheets[tile.sheet], tile.x, tile.y, tile.width, tile.height,
+												  0, 0, tile.width, tile.height);
+				$(canvas).attr("file_name", tile.name)
+					.click(function () {
+						enter_detail_image_view($(this).attr("file_name"), CURRENT_IMAGE_TYPE, this.toDataURL());
+					});
+				$div.append(canvas);
+			}
+		};
+		sheet.src = DATA_PATH + dir + "/" + sheet_name;
+		sheets.push(sheet);
 	});
 }
 
@@ -0,0 +1,109 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+import warnings as _warnings
+
+import numpy as np
+
+from . import radqy as rq
+
+
+# SNR9 is the local binary pattern of the foreground, which is a float image
+# for float input; scikit-image warns about that on every slice.
+_warnings.filterwarnings('ignore', message='Applying `local_binary_pattern` to floating-point images',
+                         category=UserWarning)
+
+# In-process entry point for computing IQMs on an array that is already in
+# memory. compute_iqms reads no files, writes no files and keeps no state
+# between calls beyond the table of metric names, so it can be called from
+# many threads of one process at once.
+
+@dataclass(frozen=True)
+class IQMResult:
+    """The IQMs of one volume.
+
+    metrics holds the mean of every metric over the sampled slices (the
+    values of a results.tsv row); slice_metrics the per-slice values, in
+    the order of slices, the indices of the sampled slices in the input.
+    """
+    metrics: Dict[str, float]
+    slice_metrics: Dict[str, np.ndarray]
+    slices: Tuple[int, ...]
+    shape: Tuple[int, ...]
+    spacing: Optional[Tuple[float, ...]] = None
+    modality: str = 'MRI'
+    warnings: Tuple[str, ...] = field(default_factory=tuple)
+
+    def __getitem__(self, name):
+        return self.metrics[name]
+
+
+@lru_cache(maxsize=None)
+def metric_table():
+    """{metric name: funcN} of the metrics RadQy computes, in output order."""
+    # The funcN return their name with their value, so each is run once on
+    # a small synthetic slice to learn it.
+    y, x = np.mgrid[:32, :32]
+    image = (100 + 50 * ((y - 16) ** 2 + (x - 16) ** 2 < 100) + (x * 7 + y * 3) % 11).astype(np.int64)
+    mask = (y - 16) ** 2 + (x - 16) ** 2 < 100
+    table = {}
+    with np.errstate(all='ignore'):
+        for func in rq.metric_functions():
+            name, _ = rq.call_metric(func, rq.SliceContext.from_mask(image, mask))
+            table[name] = func
+    return table
+
+
+def compute_iqms(volume_array, spacing=None, modality='MRI', metrics=None, sample=1, middle=100,
+                 mask_mode='slice', mask_tolerance=0.02, precision='float64'):
+    """IQMs of a (n_slices, H, W) volume (or a single (H, W) slice).
+
+    spacing is passed through to the result. modality 'CT' shifts every
+    slice to start at zero as the CT pipeline does. metrics restricts the
+    computation to the named metrics ('MEAN', 'SNR1', ...; default all);
+    sample and middle select the slices as radqy's -b and -u options do,
+    every sample-th slice of the middle middle percent. The remaining
+    arguments are those of --mask-mode, --mask-tolerance and --precision.
+    """
+    if modality not in ('MRI', 'CT'):
+        raise ValueError(f"modality must be 'MRI' or 'CT', not {modality!r}")
+    volume = volume_array if hasattr(volume_array, '__getitem__') and hasattr(volume_array, 'shape') else np.asarray(volume_array)
+    if len(volume.shape) == 2:
+        volume = np.asarray(volume)[None]
+        window = range(1)
+    elif len(volume.shape) == 3:
+        window = rq.middle_slices(volume.shape[0], middle)
+    else:
+        raise ValueError(f"Expected a (n_slices, H, W) volume or an (H, W) slice, got shape {volume.shape}")
+    slices = tuple(window[::sample])
+    if not slices:
+        raise ValueError(f"No slices selected from a volume of {volume.shape[0]} slices with middle={middle}")
+
+    table = metric_table()
+    if metrics is None:
+        functions = list(table.values())
+    else:
+        unknown = [name for name in metrics if name not in table]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}; available: {list(table)}")
+        functions = [func for name, func in table.items() if name in set(metrics)]
+
+    sampled = []
+    for j in slices:
+        I = np.asarray(volume[j])
+        if modality == 'CT':
+            I = rq.shift_to_zero(I)
+        sampled.append(I)
+    sampled = np.stack(sampled)
+
+    # Empty foregrounds, flat patches and negative local variances are
+    # handled by the metrics' own fallbacks; np.errstate is per thread.
+    with np.errstate(all='ignore'):
+        masks, irregular = rq.sampled_masks(sampled, mask_mode, mask_tolerance)
+        outputs = rq.sampled_metrics(sampled, masks, irregular, functions, precision)
+    warnings = tuple(f"slice {slices[k]}: no foreground mask, the whole slice was used" for k in sorted(irregular))
+    return IQMResult(metrics={name: float(np.mean(values)) for name, values in outputs.items()},
+                     slice_metrics={name: np.asarray(values) for name, values in outputs.items()},
+                     slices=slices, shape=tuple(volume.shape),
+                     spacing=tuple(float(s) for s in spacing) if spacing is not None else None,
+                     modality=modality, warnings=warnings)
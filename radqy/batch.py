@@ -0,0 +1,302 @@
+import numpy as np
+from scipy import ndimage as ndi
+
+
+# Batched counterparts of the per-slice metric functions in radqy.py.
+#
+# Every metric here takes a SliceStack built from the sampled slices of one
+# volume, shape (n_slices, H, W), and the matching stack of foreground masks,
+# and returns the metric name together with one value per slice. The values
+# reproduce funcN(F, B, c, f, b) slice by slice, including its fallbacks
+# (NaNs replaced by 1e-6, empty foreground/background treated as [1e-6]).
+#
+# With precision='float32' the full-size intermediates (the cleaned image,
+# F and B, filter outputs) are kept in float32, which holds 16-bit integer
+# data exactly, while sums and means still accumulate in float64. The
+# error bounds against float64 are listed under --precision in the README.
+
+
+class lazy:
+    """A property computed on first access and then stored on the instance.
+
+    functools.cached_property does the same, but up to Python 3.11 it holds
+    one lock per property for the whole class while any instance computes
+    it, so threads scoring different stacks (compute_iqms) would take turns.
+    A value computed twice by racing threads of one instance is the same.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        # stored in the instance __dict__, which later reads find first
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+class SliceStack:
+
+    def __init__(self, images, masks, precision='float64'):
+        self.images = images
+        self.masks = masks.astype(bool, copy=False)
+        self.float = np.dtype(precision)
+        if self.float == np.float64:
+            # Same dtype as ``ch * img`` in IQM.foreground.
+            self.dtype = np.result_type(np.int64, images.dtype)
+        else:
+            self.dtype = self.float
+        self.n, self.h, self.w = images.shape
+
+    @lazy
+    def F(self):
+        return np.multiply(self.masks, self.images, dtype=self.dtype)
+
+    @lazy
+    def B(self):
+        return np.multiply(~self.masks, self.images, dtype=self.dtype)
+
+    @lazy
+    def values(self):
+        # Under the mask F equals the image and outside it B does, so the
+        # fg (f) and bg (b) statistics both read from the cleaned image.
+        return np.nan_to_num(self.images.astype(self.float), nan=1e-6)
+
+    @lazy
+    def F_clean(self):
+        return np.nan_to_num(self.F, nan=1e-6)
+
+    @lazy
+    def f_count(self):
+        return self.masks.sum(axis=(1, 2))
+
+    @lazy
+    def b_count(self):
+        return self.n_pixels - self.f_count
+
+    @property
+    def n_pixels(self):
+        return self.h * self.w
+
+    def _masked_mean(self, where, count):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.mean(self.values, axis=(1, 2), where=where, dtype=np.float64)
+        return np.where(count > 0, mean, 1e-6)
+
+    def _masked_std(self, where, count):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.std(self.values, axis=(1, 2), where=where, dtype=np.float64)
+        return np.where(count > 0, std, 0.0)
+
+    @lazy
+    def f_mean(self):
+        return self._masked_mean(self.masks, self.f_count)
+
+    @lazy
+    def f_std(self):
+        return self._masked_std(self.masks, self.f_count)
+
+    @lazy
+    def f_var(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = np.var(self.values, axis=(1, 2), where=self.masks, dtype=np.float64)
+        return np.where(self.f_count > 0, var, 0.0)
+
+    @lazy
+    def b_mean(self):
+        return self._masked_mean(~self.masks, self.b_count)
+
+    @lazy
+    def b_std(self):
+        return self._masked_std(~self.masks, self.b_count)
+
+    def _masked_median_of_squares(self, where, count):
+        # np.median(clean_array(x) ** 2) per slice. Integers are squared in
+        # int64: squared in their stored dtype, as NIfTI and MetaImage
+        # volumes used to be, 8- and 16-bit values wrap around.
+        images = self.images
+        if images.dtype.kind == 'f':
+            images = np.nan_to_num(images, nan=1e-6)
+        else:
+            images = images.astype(np.int64)
+        squares = np.square(images).astype(self.float).reshape(self.n, -1)
+        squares = np.sort(np.where(where.reshape(self.n, -1), squares, np.inf), axis=1)
+        rows = np.arange(self.n)
+        lo = squares[rows, np.maximum(count - 1, 0) // 2]
+        hi = squares[rows, count // 2]
+        return np.where(count > 0, (lo + hi) / 2, 1e-12)
+
+    def patch(self, image, patch_size=5):
+        """Batched ``patch``: the window above and left of the first maximum."""
+        h = int(np.floor(patch_size / 2))
+        size = 2 * h + 1
+        flat = image.reshape(self.n, -1).argmax(axis=1)
+        a, b = np.divmod(flat, self.w)
+        # patch() pads by 5 and slices U[a:a+size], i.e. rows a-5 .. a-5+size-1
+        rows = a[:, None] + np.arange(size) - 5
+        cols = b[:, None] + np.arange(size) - 5
+        valid = (rows >= 0)[:, :, None] & (cols >= 0)[:, None, :]
+        out = image[np.arange(self.n)[:, None, None],
+                    np.clip(rows, 0, None)[:, :, None],
+                    np.clip(cols, 0, None)[:, None, :]]
+        return np.where(valid, out, 0)
+
+    @lazy
+    def fore_patch(self):
+        return np.nan_to_num(self.patch(self.F), nan=1e-6).astype(np.float64)
+
+    @lazy
+    def back_patch(self):
+        return np.nan_to_num(self.patch(self.B), nan=1e-6).astype(np.float64)
+
+
+def mean(S):
+    return 'MEAN', S.f_mean
+
+
+def rng(S):
+    with np.errstate(invalid='ignore'):
+        top = np.max(S.values, axis=(1, 2), where=S.masks, initial=-np.inf)
+        bottom = np.min(S.values, axis=(1, 2), where=S.masks, initial=np.inf)
+    return 'RNG', np.where(S.f_count > 0, top.astype(np.float64) - bottom, 0.0)
+
+
+def var(S):
+    return 'VAR', S.f_var
+
+
+def cv(S):
+    m = S.f_mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        measure = np.where(m > 0, (S.f_std / m) * 100, 0)
+    return 'CV', measure
+
+
+def cpp(S):
+    filt = np.array([[-1/8, -1/8, -1/8], [-1/8, 1, -1/8], [-1/8, -1/8, -1/8]])
+    I_hat = ndi.convolve(S.F.astype(S.float), filt[None].astype(S.float), mode='constant', cval=0.0)
+    return 'CPP', np.mean(np.nan_to_num(I_hat, nan=1e-6), axis=(1, 2), dtype=np.float64)
+
+
+def _median_filter(x, size=5, max_pixels=2**19):
+    # median(x, square(size)) with 'nearest' borders, as the middle order
+    # statistic of each window. Runs a few slices at a time because the
+    # window view is copied (size**2 values per pixel) by np.partition.
+    r = size // 2
+    if x.dtype.kind in 'iu' and x.size:
+        # Selection is cheaper on narrow integers; the cast is exact.
+        x = x.astype(np.result_type(np.min_scalar_type(x.min()), np.min_scalar_type(x.max())), copy=False)
+    out = np.empty(x.shape, dtype=x.dtype)
+    step = max(1, max_pixels // x[0].size)
+    for start in range(0, x.shape[0], step):
+        part = np.pad(x[start:start + step], ((0, 0), (r, r), (r, r)), mode='edge')
+        windows = np.lib.stride_tricks.sliding_window_view(part, (size, size), axis=(1, 2))
+        windows = windows.reshape(windows.shape[:3] + (size * size,))
+        out[start:start + step] = np.partition(windows, size * size // 2, axis=-1)[..., size * size // 2]
+    return out
+
+
+def psnr(S):
+    F = S.F_clean
+    max_val = F.max(axis=(1, 2)).astype(np.float64)
+    safe_max = np.where(max_val > 0, max_val, 1)
+    # Dividing by the (positive) maximum keeps the order of the values, so
+    # filtering first and dividing after gives the same medians.
+    I_hat = _median_filter(F) / safe_max[:, None, None].astype(S.float)
+    mse = np.mean((F - I_hat) ** 2, axis=(1, 2), dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        measure = np.where(mse > 0, 20 * np.log10(max_val / (np.sqrt(mse) + 1e-9)), 0)
+    return 'PSNR', np.where(max_val > 0, measure, 0)
+
+
+def snr1(S):
+    return 'SNR1', S.f_std / (S.b_std + 1e-9)
+
+
+def snr2(S):
+    # func8 averages the patch before cleaning it.
+    return 'SNR2', np.mean(S.patch(S.F), axis=(1, 2)) / (S.b_std + 1e-9)
+
+
+def snr3(S):
+    fp = S.fore_patch
+    fp_mean = np.mean(fp, axis=(1, 2))
+    std_diff = np.std(fp - fp_mean[:, None, None], axis=(1, 2))
+    std_diff = np.where(std_diff > 0, std_diff, 1e-9)
+    return 'SNR3', fp_mean / std_diff
+
+
+def snr4(S):
+    bg_std = np.std(S.back_patch, axis=(1, 2))
+    bg_std = np.where(bg_std > 0, bg_std, 1e-9)
+    return 'SNR4', np.mean(S.fore_patch, axis=(1, 2)) / bg_std
+
+
+def _box_sums(x, window_size):
+    # 'valid' sums over window_size x window_size windows of every slice,
+    # exact for integer input like conv2 with a ones kernel.
+    h = x.shape[1] - window_size + 1
+    rows = sum(x[:, k:k + h] for k in range(window_size))
+    w = x.shape[2] - window_size + 1
+    return sum(rows[:, :, k:k + w] for k in range(window_size))
+
+
+def snr5(S):
+    window_size = 5
+    F = S.F if S.dtype.kind != 'f' else S.F.astype(S.float)
+    local_variance = _box_sums(F ** 2, window_size) / window_size**2 - \
+                     (_box_sums(F, window_size) / window_size)**2
+    local_variance = np.nan_to_num(local_variance, nan=1e-6)
+    with np.errstate(invalid='ignore'):
+        noise_estimate = np.sqrt(np.mean(local_variance, axis=(1, 2), dtype=np.float64))
+        measure = np.where(noise_estimate > 0, S.f_mean / (noise_estimate + 1e-9), 0)
+    return 'SNR5', measure
+
+
+def cnr(S):
+    fp, bp = S.fore_patch, S.back_patch
+    return 'CNR', np.mean(fp - bp, axis=(1, 2)) / (np.std(bp, axis=(1, 2)) + 1e-6)
+
+
+def cvp(S):
+    fp = S.fore_patch
+    return 'CVP', np.std(fp, axis=(1, 2)) / (np.mean(fp, axis=(1, 2)) + 1e-6)
+
+
+def cjv(S):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        measure = (S.f_std + S.b_std) / abs(S.f_mean - S.b_mean)
+    return 'CJV', measure
+
+
+def efc(S):
+    F = S.F_clean
+    n_vox = S.n_pixels
+    if n_vox == 0:
+        return 'EFC', np.zeros(S.n)
+    efc_max = 1.0 * n_vox * (1.0 / np.sqrt(n_vox)) * np.log(1.0 / np.sqrt(n_vox))
+    cc = (F**2).sum(axis=(1, 2))
+    with np.errstate(invalid='ignore'):
+        b_max = np.where(cc > 0, np.sqrt(np.abs(cc)), 1e-6)[:, None, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        b_max = b_max.astype(S.float)
+        measure = (1.0 / abs(efc_max)) * np.sum((F / b_max) * np.log((F + 1e-16) / b_max), axis=(1, 2), dtype=np.float64)
+    return 'EFC', measure
+
+
+def fber(S):
+    fg_mu = S._masked_median_of_squares(S.masks, S.f_count)
+    bg_mu = S._masked_median_of_squares(~S.masks, S.b_count)
+    return 'FBER', np.where(bg_mu > 1.0e-3, fg_mu / (bg_mu + 1e-6), 0)
+
+
+def chunks(n_slices, slice_pixels, max_pixels=2**24):
+    """Splits the slice axis so each chunk holds at most max_pixels voxels."""
+    step = max(1, max_pixels // max(slice_pixels, 1))
+    return [(start, min(start + step, n_slices)) for start in range(0, n_slices, step)]
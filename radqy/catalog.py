@@ -0,0 +1,123 @@
+import json
+import sqlite3
+
+from .discovery import DICOM_INDEX_TAGS, read_dicom_headers
+
+
+# On-disk index of an input folder, kept next to the results.
+#
+# ``files`` has one row per image file with the size and mtime it had when it
+# was indexed and, for DICOM files, the DICOM_INDEX_TAGS header fields. A
+# rescan only reads the headers of files that are new or whose size or mtime
+# changed. ``subjects`` has one row per participant of the last scan and
+# the file(s) it is loaded from; it is written for inspection of the
+# catalog and not read back.
+
+COLUMNS = {
+    'PatientID': 'patient_id',
+    'StudyInstanceUID': 'study_uid',
+    'SeriesInstanceUID': 'series_uid',
+    'InstanceNumber': 'instance_number',
+    'ImagePositionPatient': 'image_position',
+    'ImageOrientationPatient': 'image_orientation',
+    'Rows': 'n_rows',
+    'Columns': 'n_columns',
+    'BitsAllocated': 'bits_allocated',
+}
+
+# Bumped whenever the tables change; an older catalog is rebuilt.
+SCHEMA_VERSION = 2
+
+# Multi-valued header fields, stored as JSON text.
+JSON_TAGS = ('ImagePositionPatient', 'ImageOrientationPatient')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    patient_id TEXT,
+    study_uid TEXT,
+    series_uid TEXT,
+    instance_number INTEGER,
+    image_position TEXT,
+    image_orientation TEXT,
+    n_rows INTEGER,
+    n_columns INTEGER,
+    bits_allocated INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+CREATE TABLE IF NOT EXISTS subjects (
+    subject_id TEXT NOT NULL,
+    subject_type TEXT NOT NULL,
+    paths TEXT NOT NULL,
+    position INTEGER PRIMARY KEY
+);
+CREATE INDEX IF NOT EXISTS subjects_id ON subjects (subject_id);
+"""
+
+
+class Catalog:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript('DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS subjects;')
+            self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, files, io_threads=16):
+        """Brings the files table in line with ``files`` ({path: (size, mtime_ns)}).
+
+        Returns {path: header} for the DICOM files, with headers shaped like
+        discovery.read_dicom_header. Only new or modified DICOM files are
+        read; files that fail to read are not stored, so they are retried on
+        the next scan.
+        """
+        db = self.connection
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in db.execute('SELECT path, size, mtime_ns FROM files')}
+        gone = [(path,) for path in known if path not in files]
+        changed = [path for path, stat in files.items() if known.get(path) != stat]
+        changed_dicom = [path for path in changed if path.endswith('.dcm')]
+        fresh = dict(zip(changed_dicom, read_dicom_headers(changed_dicom, io_threads)))
+
+        rows = []
+        for path in changed:
+            header = fresh.get(path)
+            if header is not None and header['error'] is not None:
+                continue
+            values = [_encode(tag, header[tag]) if header else None for tag in DICOM_INDEX_TAGS]
+            rows.append((path,) + tuple(files[path]) + tuple(values))
+        with db:
+            db.executemany('DELETE FROM files WHERE path = ?', gone)
+            db.executemany(f"INSERT OR REPLACE INTO files (path, size, mtime_ns, {', '.join(COLUMNS.values())}) "
+                           f"VALUES ({', '.join('?' * (3 + len(COLUMNS)))})", rows)
+        print(f'The catalog {self.path} has {len(files)} files; {len(changed)} were new or modified and {len(gone)} were removed.')
+
+        headers = {}
+        query = f"SELECT path, {', '.join(COLUMNS.values())} FROM files WHERE path LIKE '%.dcm'"
+        for path, *values in db.execute(query):
+            header = {tag: _decode(tag, value) for tag, value in zip(DICOM_INDEX_TAGS, values)}
+            header['error'] = None
+            headers[path] = header
+        headers.update({path: header for path, header in fresh.items() if header['error'] is not None})
+        return headers
+
+    def set_subjects(self, subject_ids, subject_types, paths):
+        with self.connection as db:
+            db.execute('DELETE FROM subjects')
+            db.executemany('INSERT INTO subjects (position, subject_id, subject_type, paths) VALUES (?, ?, ?, ?)',
+                           [(i, subject, subject_type, json.dumps(path))
+                            for i, (subject, subject_type, path) in enumerate(zip(subject_ids, subject_types, paths))])
+
+
+def _encode(tag, value):
+    return json.dumps(value) if tag in JSON_TAGS and value is not None else value
+
+
+def _decode(tag, value):
+    return json.loads(value) if tag in JSON_TAGS and value is not None else value
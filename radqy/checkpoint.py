@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# checkpoint.jsonl: the scored participants of a run, one JSON line each,
+# appended as they finish. A line holds the subject id, the fingerprint of
+# its input and the row it got (its output fields, their values and its
+# per-slice metrics). `--resume` reuses the rows whose fingerprint still
+# matches and scores only new or changed participants; a crash leaves the
+# lines written so far, and a torn last line is ignored.
+#
+# The fingerprint hashes the path, size and mtime of every input file of
+# the participant together with the settings that change the results or
+# the files written, so rerunning with other -b, -u, -t or -s options
+# scores everything again.
+
+# Settings whose change invalidates the stored rows: those that change the
+# values and those that change the files written beside them (masks,
+# thumbnails and sprite sheets).
+FINGERPRINT_SETTINGS = ('sample_size', 'middle_size', 'scan_type', 'mask_mode', 'mask_tolerance',
+                        'precision', 'rescale', 'timeseries', 'time_batch',
+                        'metric_scope', 'adaptive', 'confidence',
+                        'adaptive_metrics', 'empty_slices', 'empty_fraction', 'empty_weight',
+                        'save_masks_flag', 'thumb_size', 'thumb_layout')
+
+
+def fingerprint(paths, settings):
+    if isinstance(paths, str):
+        paths = [paths]
+    h = hashlib.sha1()
+    h.update(json.dumps([settings.get(key) for key in FINGERPRINT_SETTINGS]).encode())
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+            h.update(f"{path}\t{st.st_size}\t{st.st_mtime_ns}\n".encode())
+        except OSError:
+            h.update(f"{path}\tmissing\n".encode())
+    return h.hexdigest()
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    # header values such as person names, as results.tsv shows them
+    return str(value)
+
+
+def _line(subject, digest, s):
+    row = {field: s[field] for field in s["output"]}
+    row["output"] = list(s["output"])
+    row["participant_scan_number"] = s["participant_scan_number"]
+    if "slice_metrics" in s:
+        row["slice_metrics"] = s["slice_metrics"]
+    return json.dumps({'subject': subject, 'fingerprint': digest, 'row': row}, default=_json_value) + '\n'
+
+
+class ScoredRow(dict):
+    """A row read back from the checkpoint, in the shape of an IQM result."""
+
+    def get_participant_scan_number(self):
+        return self["participant_scan_number"]
+
+
+class Checkpoint:
+    """Reads and appends checkpoint.jsonl."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def load(self):
+        """{subject id: (fingerprint, ScoredRow)} of the complete lines; the latest line of a subject wins."""
+        rows = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    rows[record['subject']] = (record['fingerprint'], ScoredRow(record['row']))
+        except OSError:
+            pass
+        return rows
+
+    def open(self, mode='a'):
+        self.file = open(self.path, mode, buffering=1)
+
+    def append(self, subject, digest, s):
+        self.file.write(_line(subject, digest, s))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rewrite(self, entries):
+        """Atomically replaces the file with the given [(subject, fingerprint, row)]."""
+        self.close()
+        partial = str(self.path) + '.partial'
+        with open(partial, 'w') as f:
+            for subject, digest, s in entries:
+                f.write(_line(subject, digest, s))
+        os.replace(partial, self.path)
@@ -2,11 +2,50 @@ import sys
 import argparse
 import datetime
 
-from .radqy import main
-
 from .ui_handlers import ui_download, ui_unzip, ui_run
 
+
+def add_scoring_arguments(parser):
+    """Options of how participants are read and scored, shared by the batch and serve modes."""
+    parser.add_argument('-s', help="save foreground masks", type=lambda x: False if x == '0' else x, default=False)
+    parser.add_argument('-b', help="number of samples", type=int, default=1)
+    parser.add_argument('-u', help="percent of middle images", type=int, default=100)
+    parser.add_argument('-t', help="type of scan (MRI or CT)", default='MRI', choices=['MRI', 'CT'])
+    parser.add_argument('--mask-mode', help="foreground masks per slice or with thresholds shared by the volume", default='slice', choices=['slice', 'volume'])
+    parser.add_argument('--mask-tolerance', help="fraction of changed foreground pixels before a slice gets its own hull (volume mask mode)", type=float, default=0.02)
+    parser.add_argument('--io-threads', help="threads used to read the DICOM headers of the input folder", type=int, default=16)
+    parser.add_argument('--workers', help="number of worker processes for the participants", type=int, default=1)
+    parser.add_argument('--metric-scope', help="average every metric over the sampled slices, or compute it once over the voxels of the middle window", default='slice', choices=['slice', 'volume'])
+    parser.add_argument('--adaptive', help="sample slices middle first until the means of the tested metrics are within this relative tolerance (e.g. 0.05) instead of every b-th slice", type=float, default=None, metavar='TOL')
+    parser.add_argument('--adaptive-metrics', help="comma-separated metrics that must converge for --adaptive to stop (default: MEAN,RNG,PSNR,EFC,FBER)", type=lambda x: x.split(','), default=None, metavar='NAMES')
+    parser.add_argument('--confidence', help="confidence level of the --adaptive stopping rule", type=float, default=0.95)
+    parser.add_argument('--empty-slices', help="pre-screen the sampled slices for air and padding and keep them as before, report them, skip them or down-weight them in the averages", default='keep', choices=['keep', 'report', 'skip', 'downweight'])
+    parser.add_argument('--empty-fraction', help="a slice is empty when fewer than this fraction of its pixels are above the air level", type=float, default=0.01)
+    parser.add_argument('--empty-weight', help="weight of an empty slice in the averages of --empty-slices downweight, against 1 for the others", type=float, default=0.1)
+    parser.add_argument('--precision', help="float type of the batched metric computations (float32 halves their memory)", default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--thumb-size', help="downscale thumbnails so neither side exceeds this many pixels", type=int, default=None)
+    parser.add_argument('--thumb-layout', help="one PNG per thumbnail, or one sprite sheet and sprite.json manifest per participant", default='files', choices=['files', 'sprite'])
+    parser.add_argument('--rescale', help="apply the DICOM RescaleSlope and RescaleIntercept to the pixel values", action='store_true')
+
+
+def serve_cli(argv):
+    from .serve import serve
+
+    parser = argparse.ArgumentParser(prog='radqy serve', description='Score studies as they arrive in a watched folder.')
+    parser.add_argument('output_folder_name', type=str, help="The subfolder name in the '...\\UserInterface\\Data\\output_folder_name' directory; rows are added to its results.tsv.")
+    parser.add_argument('--watch', required=True, help="folder the scanner export writes to")
+    parser.add_argument('--poll', help="seconds between scans of the watched folder", type=float, default=1.0)
+    parser.add_argument('--quiescence', help="seconds without changes before a series or file is complete", type=float, default=5.0)
+    parser.add_argument('--idle-exit', help="stop after this many seconds without new data (default: run until interrupted)", type=float, default=None)
+    add_scoring_arguments(parser)
+    serve(parser.parse_args(argv))
+
+
 def run_cli():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_cli(sys.argv[2:])
+        return
+
     headers = []
     headers.append(f"start_time:\t{datetime.datetime.now()}")
 
@@ -21,10 +60,16 @@ def run_cli():
     parser.add_argument('inputdir', nargs='*', help="Input folder name consisting of *.dcm, *.mha, *.nii or *.mat files. For example: 'E:\\Data\\Rectal\\input_data_folder'")
    
     # Optional arguments
-    parser.add_argument('-s', help="save foreground masks", type=lambda x: False if x == '0' else x, default=False)
-    parser.add_argument('-b', help="number of samples", type=int, default=1)
-    parser.add_argument('-u', help="percent of middle images", type=int, default=100)
-    parser.add_argument('-t', help="type of scan (MRI or CT)", default='MRI', choices=['MRI', 'CT'])
+    add_scoring_arguments(parser)
+    parser.add_argument('--no-catalog', help="do not keep the catalog.sqlite index of the input folder in the output folder", action='store_true')
+    parser.add_argument('--order', help="order of the rows in results.tsv (input or completion)", default='input', choices=['input', 'completion'])
+    parser.add_argument('--timeseries', help="score 4D NIfTI/MetaImage series (fMRI, DWI, DCE): spatial IQMs over time plus tSNR, drift and DVARS", action='store_true')
+    parser.add_argument('--time-batch', help="timepoints whose sampled slices are scored together in the time-series mode", type=int, default=8)
+    parser.add_argument('--resume', help="reuse the stored results of participants whose input files and settings are unchanged (checkpoint.jsonl) and score only the rest", action='store_true')
+    parser.add_argument('--columnar', help="also write typed results and per-slice tables as Parquet or Arrow IPC files (needs pyarrow)", default=None, choices=['parquet', 'arrow'])
+    parser.add_argument('--timings', help="record the time, bytes read and peak memory of every stage to timings.jsonl and print a summary", action='store_true')
+    parser.add_argument('--profile', help="profile the participant with this subject id", default=None, metavar='SUBJECT')
+    parser.add_argument('--profiler', help="profiler for --profile (pyinstrument must be installed)", default='cprofile', choices=['cprofile', 'pyinstrument'])
 
 
     args = parser.parse_args() 
@@ -41,6 +86,8 @@ def run_cli():
     if not args.output_folder_name or not args.inputdir:
         parser.error("The following arguments are required: output_folder_name, inputdir")
     else:
+        # The scientific stack is imported only once there is work to do
+        from .radqy import main
         main(args)
 
 
@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+
+from .tags import non_tag_value
+
+
+# In-memory table of the results, fed the same rows as results.tsv.
+#
+# IQM.csv (and, with pyarrow, the Parquet or Arrow IPC files) are built from
+# it when the run ends, so nothing is parsed back from the TSV text. The
+# participant rows are gathered as Python values and typed once at the end,
+# because a tag column can hold a number for one participant and text for
+# another, and a Parquet or IPC file needs its schema before the first
+# batch; there is one row per participant, and IQM.csv needs them all. The
+# per-slice rows, one per sampled slice of every participant, have the same
+# columns and types throughout a run, so with a columnar format they are
+# written to the slices file a record batch of BATCH_ROWS rows at a time,
+# with the schema of the first batch, and not kept. Tag values missing from
+# a header ('NA') are nulls here and 'N/A' in IQM.csv, as they were when
+# IQM.csv was read back from the TSV.
+
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Slice rows per record batch of the slices file.
+BATCH_ROWS = 10000
+
+
+def require_pyarrow():
+    # optional, only needed for --columnar
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Columnar output needs pyarrow: pip install 'radqy[columnar]'")
+    return pyarrow
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+
+
+def _typed(frame):
+    import pandas as pd
+    # Object columns become numeric when every value is a number, lists stay
+    # lists and anything else becomes text.
+    for name in frame.columns:
+        column = frame[name]
+        if column.dtype != object:
+            continue
+        column = column.map(lambda v: None if isinstance(v, str) and v == non_tag_value else v)
+        present = column.dropna()
+        if all(_is_number(v) for v in present):
+            frame[name] = pd.to_numeric(column)
+        elif all(isinstance(v, list) for v in present):
+            frame[name] = column
+        else:
+            frame[name] = column.map(lambda v: v if v is None or (isinstance(v, float) and v != v) else str(v))
+    return frame
+
+
+def _slice_column(values):
+    # the types the columns had as Python values: float64, int64 or bool
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return values.astype(np.float64, copy=False)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64, copy=False)
+    return values
+
+
+class ResultTable:
+    """The participant rows (and per-slice metrics) of one run, as columns.
+
+    With fmt (a COLUMNAR_FORMATS key) the per-slice metrics are streamed to
+    slices<ext> in folder, through a .partial file that close() moves in
+    place; without it they are not kept.
+    """
+
+    def __init__(self, folder=None, fmt=None, batch_rows=BATCH_ROWS):
+        self.rows = []
+        self.folder = folder
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.pending = []
+        self.pending_rows = 0
+        self.schema = None
+        self.sink = None
+        self.writer = None
+        if fmt is not None:
+            self.slices_path = folder / ('slices' + COLUMNAR_FORMATS[fmt])
+            self.partial = self.slices_path.with_name(self.slices_path.name + '.partial')
+
+    def append(self, s):
+        self.rows.append({field: s[field] for field in s["output"]})
+        slices = s.get("slice_metrics")
+        if self.fmt is None or not slices or not len(slices["Slice"]):
+            return
+        n = len(slices["Slice"])
+        self.pending.append({"Participant": np.full(n, s["Participant"], dtype=object),
+                             **{name: _slice_column(values) for name, values in slices.items()}})
+        self.pending_rows += n
+        if self.pending_rows >= self.batch_rows:
+            self._flush()
+
+    def _flush(self):
+        # one record batch of the pending slice rows; the first fixes the schema
+        if not self.pending:
+            return
+        pa = require_pyarrow()
+        import pandas as pd
+        names = list(dict.fromkeys(name for part in self.pending for name in part))
+        frame = pd.DataFrame({name: np.concatenate([part[name] if name in part else np.full(len(part["Slice"]), None)
+                                                    for part in self.pending])
+                              for name in names})
+        self.pending, self.pending_rows = [], 0
+        table = pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            if self.fmt == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.partial, self.schema)
+            else:
+                self.sink = pa.OSFile(str(self.partial), 'wb')
+                self.writer = pa.ipc.new_file(self.sink, self.schema)
+        self.writer.write_table(table)
+
+    def close(self, commit=True):
+        """Writes the last slice rows and moves the slices file in place, or with commit=False removes it."""
+        if self.fmt is None:
+            return
+        if commit:
+            self._flush()
+        if self.writer is not None:
+            self.writer.close()
+            if self.sink is not None:
+                self.sink.close()
+            self.writer = self.sink = None
+            if commit:
+                os.replace(self.partial, self.slices_path)
+            else:
+                os.remove(self.partial)
+        elif commit:
+            # no participant had sampled slices: an empty table, as before
+            self._write(require_pyarrow().table({}), self.slices_path)
+
+    def frame(self):
+        """Participants by columns, in the order they were written."""
+        import pandas as pd
+        return _typed(pd.DataFrame(self.rows))
+
+    def write_csv(self, path):
+        frame = self.frame().drop(['Name of Images'], axis=1, errors='ignore')
+        frame = frame.astype(object).where(frame.notna(), 'N/A')
+        frame.to_csv(path, index=False)
+
+    def _write(self, table, path):
+        pa = require_pyarrow()
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    def write_columnar(self):
+        """Writes results<ext> and finishes slices<ext> in the folder as Parquet or Arrow IPC files."""
+        pa = require_pyarrow()
+        path = self.folder / ('results' + COLUMNAR_FORMATS[self.fmt])
+        self._write(pa.Table.from_pandas(self.frame(), preserve_index=False), path)
+        self.close()
+        return [path, self.slices_path]
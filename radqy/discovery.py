@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+# File types RadQy reads, by extension.
+IMAGE_EXTENSIONS = ('.dcm', '.mha', '.nii', '.gz', '.mat')
+
+# Header fields read for every DICOM file when the input folder is indexed.
+DICOM_INDEX_TAGS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'InstanceNumber',
+                    'ImagePositionPatient', 'ImageOrientationPatient', 'Rows', 'Columns', 'BitsAllocated']
+
+
+def read_dicom_header(dicom_file):
+    """Reads the indexed tags of one DICOM file without decoding its pixel data.
+
+    Returns a dict keyed by the DICOM_INDEX_TAGS keywords (None when a tag is
+    missing) plus 'error', which holds the read error if the file could not
+    be parsed.
+    """
+    import pydicom
+    header = dict.fromkeys(DICOM_INDEX_TAGS)
+    header['error'] = None
+    try:
+        dcm_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=DICOM_INDEX_TAGS)
+    except Exception as e:
+        header['error'] = e
+        return header
+    for tag in DICOM_INDEX_TAGS:
+        value = dcm_data.get(tag, None)
+        if value is None or value == '':
+            continue
+        if tag in ('InstanceNumber', 'Rows', 'Columns', 'BitsAllocated'):
+            try:
+                header[tag] = int(value)
+            except (TypeError, ValueError):
+                pass
+        elif tag in ('ImagePositionPatient', 'ImageOrientationPatient'):
+            try:
+                header[tag] = [float(v) for v in value]
+            except (TypeError, ValueError):
+                pass
+        else:
+            header[tag] = str(value).strip()
+    return header
+
+
+def read_dicom_headers(dicom_files, io_threads=16):
+    """read_dicom_header for many files on a thread pool; results keep the input order.
+
+    Header reads are dominated by file system latency (especially on network
+    mounts), so threads overlap the waits even though parsing holds the GIL.
+    """
+    if io_threads <= 1 or len(dicom_files) <= 1:
+        return [read_dicom_header(f) for f in dicom_files]
+    with ThreadPoolExecutor(max_workers=io_threads) as pool:
+        return list(pool.map(read_dicom_header, dicom_files))
+
+
+def scan_files(root, extensions=IMAGE_EXTENSIONS):
+    """Walks root and returns {path: (size, mtime_ns)} for the image files, in os.walk order."""
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(extensions):
+                path = str(Path(dirpath) / filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def _slice_position(header):
+    # Distance of the slice along the normal of its image plane.
+    position = header['ImagePositionPatient']
+    orientation = header['ImageOrientationPatient']
+    if not position or not orientation or len(position) != 3 or len(orientation) != 6:
+        return None
+    row, col = orientation[:3], orientation[3:]
+    normal = (row[1] * col[2] - row[2] * col[1],
+              row[2] * col[0] - row[0] * col[2],
+              row[0] * col[1] - row[1] * col[0])
+    return sum(p * n for p, n in zip(position, normal))
+
+
+def sort_series(dicom_files, headers):
+    """Orders the files of one series by InstanceNumber, or by slice position
+    when the instance numbers are missing or repeated, falling back to the
+    file order."""
+    numbers = [header['InstanceNumber'] for header in headers]
+    if None not in numbers and len(set(numbers)) == len(numbers):
+        keys = numbers
+    else:
+        keys = [_slice_position(header) for header in headers]
+        if None in keys:
+            return list(dicom_files)
+    return [f for _, _, f in sorted(zip(keys, range(len(keys)), dicom_files))]
+
+
+def group_dicom_series(dicom_files, headers):
+    """Groups DICOM files into series, one participant per series.
+
+    Files are keyed by (PatientID, StudyInstanceUID, SeriesInstanceUID); files
+    without a SeriesInstanceUID are grouped by their folder. Returns
+    {subject_id: sorted file list} in the order the series are first seen,
+    with subject ids of the form '<PatientID>_<SeriesInstanceUID>'.
+    Unreadable files are reported and left out.
+    """
+    series = {}
+    for dicom_file, header in zip(dicom_files, headers):
+        if header['error'] is not None:
+            print(f"Could not read DICOM file: {dicom_file}. Error: {header['error']}")
+            continue
+        patient_id = header['PatientID'] or "Unknown"
+        series_id = header['SeriesInstanceUID'] or Path(dicom_file).parent.name
+        key = (patient_id, header['StudyInstanceUID'], series_id)
+        series.setdefault(key, ([], []))
+        series[key][0].append(dicom_file)
+        series[key][1].append(header)
+
+    subjects = {}
+    for (patient_id, _, series_id), (files, series_headers) in series.items():
+        subject_id = f"{patient_id}_{series_id}"
+        if subject_id in subjects:
+            # The same series UID under two studies; keep them apart.
+            subject_id = f"{subject_id}_{sum(s.startswith(subject_id) for s in subjects) + 1}"
+        subjects[subject_id] = sort_series(files, series_headers)
+    return subjects
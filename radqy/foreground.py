@@ -0,0 +1,303 @@
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+from skimage import exposure as ex
+from skimage.filters import threshold_otsu
+from skimage.measure import grid_points_in_poly, points_in_poly
+from skimage.morphology import convex_hull_image
+from skimage.util import unique_rows
+try:
+    from skimage.morphology._convex_hull import possible_hull
+except ImportError:  # private in scikit-image, fall back to every pixel
+    def possible_hull(image):
+        return np.transpose(np.nonzero(image))
+
+
+# Foreground masks for IQM.foreground.
+#
+# The mask is the convex hull of an Otsu threshold of a blend of the image and
+# its histogram-equalised version. For integer images every intermediate in
+# that chain (the equalised value, the blend, each threshold test) depends only
+# on the pixel value, so they are computed once per distinct value from a
+# single histogram and mapped back with a lookup table. The masks are the same
+# as the per-pixel computation, bit for bit.
+
+
+def _otsu(values, counts):
+    """threshold_otsu over an image given as its distinct (sorted) values and their counts."""
+    if len(values) == 1:
+        return values[0]
+    return threshold_otsu(hist=(counts, values))
+
+
+def _otsu_float(values, counts, nbins=256):
+    # threshold_otsu on a float image histograms it into nbins equal bins
+    # between its min and max; weighting the distinct values by their counts
+    # puts every pixel in the same bin.
+    if len(values) == 1:
+        return values[0]
+    hist, edges = np.histogram(values, bins=nbins, weights=counts)
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    return _otsu(centers, hist)
+
+
+def otsu_mask(img):
+    """Thresholded blend of the image and its equalised version, as in IQM.foreground.
+
+    Works on a single slice or, with thresholds shared by all voxels, on a
+    whole (n_slices, H, W) stack.
+    """
+    if img.dtype.kind not in 'iu':
+        return _otsu_mask_reference(img)
+    vmin = int(img.min())
+    vmax = int(img.max())
+    if img.dtype.kind == 'u':
+        index = img - img.dtype.type(vmin)
+    elif img.dtype.itemsize < 8:
+        # The difference fits the unsigned type of the same width, so
+        # wrap around in place of widening to int64.
+        index = (img - img.dtype.type(vmin)).view(np.dtype(f'u{img.dtype.itemsize}'))
+    else:
+        index = img - vmin
+    counts = np.bincount(index.ravel(), minlength=vmax - vmin + 1)
+    return _otsu_lut(np.arange(vmin, vmax + 1), counts)[index]
+
+
+def _otsu_lut(values, counts):
+    """otsu_mask of every value of the integer range values, given the histogram counts of the image."""
+    present = counts > 0
+
+    # equalize_hist(img) * 255, per value
+    cdf = counts.cumsum() / float(counts.sum())
+    h = cdf * 255
+
+    t1 = _otsu(values, counts)
+    t2 = _otsu_float(h[present], counts[present])
+    nm = counts.sum()
+    w1 = counts[values > t1].sum() / nm
+    w2 = counts[h > t2].sum() / nm
+    new = (w1 * values) + (w2 * h)
+    t3 = _otsu_float(new[present], counts[present])
+    return new > t3
+
+
+def _otsu_mask_reference(img):
+    h = ex.equalize_hist(img[:, :]) * 255
+    oi = np.zeros_like(img, dtype=np.uint16)
+    oi[(img > threshold_otsu(img)) == True] = 1
+    oh = np.zeros_like(img, dtype=np.uint16)
+    oh[(h > threshold_otsu(h)) == True] = 1
+    nm = img.size
+    w1 = np.sum(oi) / nm
+    w2 = np.sum(oh) / nm
+    new = (w1 * img) + (w2 * h)
+    return new > threshold_otsu(new)
+
+
+def convex_hull_mask(image):
+    """convex_hull_image(image) for a 2D mask, filled row by row.
+
+    The hull vertices are found as skimage does. Because the hull is convex
+    every row of it is one run of pixels, so instead of testing every pixel
+    against every edge only the pixels at the ends of each run are checked
+    with skimage's point-in-polygon test.
+    """
+    if np.count_nonzero(image) == 0:
+        return np.zeros(image.shape, dtype=bool)
+    coords = possible_hull(np.ascontiguousarray(image, dtype=np.uint8))
+    offsets = np.array([[-0.5, 0], [0.5, 0], [0, -0.5], [0, 0.5]])
+    coords = unique_rows((coords[:, np.newaxis, :] + offsets).reshape(-1, 2))
+    try:
+        hull = ConvexHull(coords)
+    except QhullError:
+        return np.zeros(image.shape, dtype=bool)
+    vertices = hull.points[hull.vertices]
+    mask = _fill_convex(image.shape, vertices)
+    if mask is None:
+        mask = grid_points_in_poly(image.shape, vertices, binarize=False) >= 1
+    return mask
+
+
+def _fill_convex(shape, vertices):
+    n_rows, n_cols = shape
+    r_min, r_max = vertices[:, 0].min(), vertices[:, 0].max()
+    rows = np.arange(max(int(np.ceil(r_min)), 0), min(int(np.floor(r_max)), n_rows - 1) + 1)
+    if len(rows) == 0:
+        return None
+
+    # Column where each edge crosses each row; edges not spanning the row
+    # are ignored, horizontal edges contribute both of their end points.
+    start = vertices
+    stop = np.roll(vertices, -1, axis=0)
+    r1, c1 = start[:, 0], start[:, 1]
+    r2, c2 = stop[:, 0], stop[:, 1]
+    R = rows[:, None].astype(np.float64)
+    spans = (R >= np.minimum(r1, r2)) & (R <= np.maximum(r1, r2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cross = c1 + (R - r1) * (c2 - c1) / (r2 - r1)
+    flat = r1 == r2
+    lo = np.where(spans & ~flat, cross, np.inf).min(axis=1)
+    hi = np.where(spans & ~flat, cross, -np.inf).max(axis=1)
+    lo = np.minimum(lo, np.where(spans & flat, np.minimum(c1, c2), np.inf).min(axis=1))
+    hi = np.maximum(hi, np.where(spans & flat, np.maximum(c1, c2), -np.inf).max(axis=1))
+    first = np.clip(np.ceil(lo), 0, n_cols).astype(np.int64)
+    last = np.clip(np.floor(hi), -1, n_cols - 1).astype(np.int64)
+
+    # Check the run ends (and the pixels just past them) with the exact test.
+    runs = first <= last
+    probes = [(rows[runs], first[runs], True), (rows[runs], last[runs], True),
+              (rows, first - 1, False), (rows, last + 1, False)]
+    outside_rows = [r for r in (rows[0] - 1, rows[-1] + 1) if 0 <= r < n_rows]
+    for r in outside_rows:
+        cols = np.arange(n_cols)
+        probes.append((np.full(n_cols, r), cols, False))
+    for probe_rows, probe_cols, expected in probes:
+        keep = (probe_cols >= 0) & (probe_cols < n_cols)
+        points = np.stack([probe_rows[keep], probe_cols[keep]], axis=1).astype(np.float64)
+        if len(points) and not np.all(points_in_poly(points, vertices) == expected):
+            return None
+
+    mask = np.zeros(shape, dtype=bool)
+    cols = np.arange(n_cols)
+    mask[rows] = (cols >= first[:, None]) & (cols <= last[:, None])
+    return mask
+
+
+class VolumeThresholds:
+    """The Otsu thresholds of otsu_mask for a volume whose slices arrive in batches.
+
+    add() takes the histogram of every batch (the slices themselves for
+    float data), and once all were added, apply() thresholds any of them
+    as otsu_mask would threshold the stack of all of them.
+    """
+
+    def __init__(self):
+        self.vmin = None
+        self.counts = None
+        self.parts = []
+        self.lut = None
+        self.float = None
+
+    def add(self, images):
+        if images.dtype.kind not in 'iu' or self.parts:
+            if self.counts is not None:
+                # a float batch after integer ones: keep everything as values
+                self.parts.append(np.repeat(np.arange(self.vmin, self.vmin + len(self.counts)), self.counts))
+                self.counts = None
+            self.parts.append(images.ravel())
+            return
+        vmin, vmax = int(images.min()), int(images.max())
+        counts = np.bincount((images.astype(np.int64) - vmin).ravel(), minlength=vmax - vmin + 1)
+        if self.counts is None:
+            self.vmin, self.counts = vmin, counts
+            return
+        lo = min(vmin, self.vmin)
+        merged = np.zeros(max(vmax, self.vmin + len(self.counts) - 1) - lo + 1, dtype=np.int64)
+        merged[self.vmin - lo:self.vmin - lo + len(self.counts)] += self.counts
+        merged[vmin - lo:vmin - lo + len(counts)] += counts
+        self.vmin, self.counts = lo, merged
+
+    def _finish(self):
+        if self.counts is not None:
+            self.lut = _otsu_lut(np.arange(self.vmin, self.vmin + len(self.counts)), self.counts)
+            return
+        # _otsu_mask_reference, with the equalisation kept as its cdf
+        values = np.concatenate(self.parts)
+        cdf, centers = ex.cumulative_distribution(values, 256)
+        h = self._equalize(values, cdf, centers)
+        t1 = threshold_otsu(values)
+        t2 = threshold_otsu(h)
+        w1 = np.sum(values > t1) / values.size
+        w2 = np.sum(h > t2) / values.size
+        t3 = threshold_otsu((w1 * values) + (w2 * h))
+        self.float = (cdf, centers, w1, w2, t3)
+        self.parts = []
+
+    @staticmethod
+    def _equalize(images, cdf, centers):
+        # equalize_hist(images) * 255 with the cdf of all slices
+        return np.interp(images.ravel(), centers, cdf).reshape(images.shape).astype(cdf.dtype, copy=False) * 255
+
+    def apply(self, images):
+        if self.lut is None and self.float is None:
+            self._finish()
+        if self.lut is not None:
+            index = np.clip(images.astype(np.int64) - self.vmin, 0, len(self.lut) - 1)
+            return self.lut[index]
+        cdf, centers, w1, w2, t3 = self.float
+        return (w1 * images) + (w2 * self._equalize(images, cdf, centers)) > t3
+
+
+class VolumeMasks:
+    """volume_foreground_masks of a volume masked one batch of slices at a time.
+
+    The thresholds are those of all slices added to ``thresholds`` and the
+    reused hull carries over from one batch to the next, so the masks do
+    not depend on how the slices are split into batches.
+    """
+
+    def __init__(self, thresholds, tolerance=0.02):
+        self.thresholds = thresholds
+        self.tolerance = tolerance
+        self.ref = None
+
+    def __call__(self, images):
+        ots = self.thresholds.apply(images)
+        masks = np.empty(images.shape, dtype=bool)
+        for k in range(images.shape[0]):
+            if self.ref is not None:
+                ref_ots, ref_mask = self.ref
+                changed = np.count_nonzero(ots[k] ^ ref_ots)
+                if changed <= self.tolerance * max(np.count_nonzero(ref_ots), 1):
+                    masks[k] = ref_mask
+                    continue
+            masks[k] = convex_hull_mask(ots[k])
+            self.ref = (ots[k], masks[k])
+        return masks
+
+
+def volume_foreground_masks(images, tolerance=0.02):
+    """Foreground masks for a (n_slices, H, W) stack with volume-wide thresholds.
+
+    The Otsu thresholds come from one histogram of the whole stack and are
+    applied to all slices in a single lookup. A slice reuses the hull of the
+    last slice whose hull was computed while its thresholded foreground
+    differs from that slice's by at most ``tolerance`` (as a fraction of its
+    foreground pixels).
+    """
+    thresholds = VolumeThresholds()
+    thresholds.add(images)
+    return VolumeMasks(thresholds, tolerance)(images)
+
+
+def foreground_mask(img):
+    """The convex hull foreground mask computed by IQM.foreground."""
+    return convex_hull_mask(otsu_mask(img))
+
+
+def foreground_mask_reference(img):
+    """Unoptimised form of foreground_mask, kept for comparison."""
+    return convex_hull_image(_otsu_mask_reference(img))
+
+
+def coarse_slices(stack, block=4):
+    """Block means of every slice, which average the noise of air away."""
+    n, h, w = stack.shape
+    if h < block or w < block:
+        return stack.astype(np.float32)
+    h, w = h - h % block, w - w % block
+    blocks = stack[:, :h, :w].reshape(n, h // block, block, w // block, block)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def signal_level(coarse, fraction=0.1):
+    """Intensity separating tissue from air in coarse_slices of a stack.
+
+    It lies fraction of the way from the 1st to the 99th percentile.
+    """
+    lo, hi = np.nanpercentile(coarse, [1, 99])
+    return lo + fraction * (hi - lo)
+
+
+def empty_slices(coarse, level, min_fraction=0.01):
+    """True for the slices (of coarse_slices) with fewer than min_fraction of their blocks above level (air, padding)."""
+    return np.count_nonzero(coarse > level, axis=(1, 2)) < min_fraction * coarse[0].size
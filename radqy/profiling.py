@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Per-participant, per-stage timings.
+#
+# A StageTimer adds up, for every stage it is given, the wall time, the CPU
+# time of the process, the bytes the process read (rchar of /proc/self/io,
+# which counts reads served from the page cache too, but not pages touched
+# through a memory map) and the peak resident memory so far. CPU close to
+# wall means the stage is compute bound; a stage with much more wall than
+# CPU time is waiting, usually on I/O. Bytes and memory are None where the
+# platform does not report them.
+
+# Stages that overlap the others: the whole participant, and work done on
+# background threads. They are left out of the share column.
+OVERLAPPING_STAGES = ('participant', 'thumbnail_encode')
+
+
+def _bytes_read():
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            for line in f:
+                if line.startswith(b'rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class StageTimer:
+    """Accumulates the time, bytes read and peak memory of the stages of one participant."""
+
+    def __init__(self, participant=None, enabled=True):
+        self.participant = participant
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu, read = time.perf_counter(), time.process_time(), _bytes_read()
+        try:
+            yield
+        finally:
+            after = _bytes_read()
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu,
+                     after - read if read is not None and after is not None else None)
+
+    def add(self, name, wall, cpu=None, bytes_read=None):
+        if not self.enabled:
+            return
+        record = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': None, 'bytes_read': None})
+        record['calls'] += 1
+        record['wall_s'] += wall
+        if cpu is not None:
+            record['cpu_s'] = (record['cpu_s'] or 0.0) + cpu
+        if bytes_read is not None:
+            record['bytes_read'] = (record['bytes_read'] or 0) + bytes_read
+        record['peak_rss_mb'] = _peak_rss_mb()
+
+    def records(self):
+        """One dict per stage, in the order the stages were first seen."""
+        return [{'participant': self.participant, 'stage': name, 'pid': os.getpid(), **record}
+                for name, record in self.stages.items()]
+
+
+def write_timings(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def summary_table(records):
+    """Totals of every stage over all participants, slowest first, as printable text."""
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': None, 'bytes_read': None, 'peak_rss_mb': None})
+        total['calls'] += record['calls']
+        total['wall_s'] += record['wall_s']
+        for key in ('cpu_s', 'bytes_read'):
+            if record.get(key) is not None:
+                total[key] = (total[key] or 0) + record[key]
+        if record.get('peak_rss_mb') is not None:
+            total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+    all_wall = sum(t['wall_s'] for name, t in totals.items() if name not in OVERLAPPING_STAGES) or 1.0
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'
+
+    lines = [f"{'stage':<18}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'cpu/wall':>10}{'MB read':>10}{'peak MB':>10}{'share':>8}"]
+    for name, t in sorted(totals.items(), key=lambda item: -item[1]['wall_s']):
+        ratio = t['cpu_s'] / t['wall_s'] if t['cpu_s'] is not None and t['wall_s'] > 0 else None
+        mb = t['bytes_read'] / 1e6 if t['bytes_read'] is not None else None
+        share = '' if name in OVERLAPPING_STAGES else f"{100 * t['wall_s'] / all_wall:7.1f}%"
+        lines.append(f"{name:<18}{t['calls']:>8}{t['wall_s']:>10.2f}{fmt(t['cpu_s'], '10.2f'):>10}"
+                     f"{fmt(ratio, '10.2f'):>10}{fmt(mb, '10.1f'):>10}{fmt(t['peak_rss_mb'], '10.0f'):>10}{share:>8}")
+    return "\n".join(lines)
+
+
+@contextmanager
+def profiled(path, profiler='cprofile'):
+    """Profiles the block with cProfile (a .prof file for pstats/snakeviz) or pyinstrument (an HTML report)."""
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("The pyinstrument profiler needs pyinstrument: pip install pyinstrument")
+        p = Profiler()
+        p.start()
+        try:
+            yield
+        finally:
+            p.stop()
+            with open(str(path) + '.html', 'w') as f:
+                f.write(p.output_html())
+        return
+    import cProfile
+    p = cProfile.Profile()
+    p.enable()
+    try:
+        yield
+    finally:
+        p.disable()
+        p.dump_stats(str(path) + '.prof')
@@ -1,4 +1,3 @@
-import SimpleITK as sitk
 import datetime
 import time
 import os
@@ -6,25 +5,31 @@ import sys
 import re
 import argparse
 import yaml
-import pydicom
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from itertools import accumulate
-from collections import Counter
-import matplotlib.pyplot as plt
 import inspect
-from skimage.filters import threshold_otsu
-from skimage.morphology import convex_hull_image
-from skimage.feature import local_binary_pattern
-from skimage import exposure as ex
-import pandas as pd
-import matplotlib.cm as cm
+from pathlib import Path
+from functools import lru_cache
+from contextlib import nullcontext
 from scipy.signal import convolve2d as conv2
+from skimage.feature import local_binary_pattern
 from skimage.filters import median
-from skimage.morphology import square
-from pathlib import Path
 # from scipy.io import loadmat
+from . import batch, volumetric
+from .batch import lazy
+from .foreground import (VolumeMasks, VolumeThresholds, coarse_slices, empty_slices, foreground_mask, signal_level,
+                         volume_foreground_masks)
+from .discovery import IMAGE_EXTENSIONS, group_dicom_series, read_dicom_headers, scan_files
+from .catalog import Catalog
+from .volumes import LazyVolume, dicom_volume, sitk_volume
+from .streaming import stream_volume
+from .thumbnails import ThumbnailWriter
+from .tags import TagPlan
+from .columnar import ResultTable, require_pyarrow
+from .profiling import StageTimer, profiled, summary_table, write_timings
+from .checkpoint import Checkpoint, fingerprint
+from .sampling import AdaptiveSampler
 import warnings
-warnings.filterwarnings("ignore")
 
 
 
@@ -36,148 +41,240 @@ def clean_array(array, fallback=1e-6):
         return np.array([fallback])
     return array
 
+def widen(img):
+    """Integer slices as int64, the dtype the per-slice metric functions were written for."""
+    return img.astype(np.int64) if img.dtype.kind in 'iu' else img
+
+def shift_to_zero(img):
+    """img - img.min() in the stored width: the difference of two signed
+    n-bit integers always fits the unsigned n-bit type."""
+    if img.dtype.kind == 'i' and img.dtype.itemsize < 8:
+        return (img - img.min()).view(np.dtype(f'u{img.dtype.itemsize}'))
+    return img - np.min(img)
+
 def psnr(img1, img2):
     mse = np.square(np.subtract(img1, img2)).mean()
     return 20 * np.log10(np.nanmax(img1) / np.sqrt(mse))
 
-def patch(img, patch_size):
+def patch(img, patch_size, loc=None):
     h = int(np.floor(patch_size / 2))
-    U = np.pad(img, pad_width=5, mode='constant')
-    [a, b] = np.where(img == np.max(img))
-    a = a[0]
-    b = b[0]
-    return U[a:a+2*h+1, b:b+2*h+1]
+    if loc is None:
+        loc = max_location(img)
+    a, b = loc
+    # Same window as np.pad(img, pad_width=5)[a:a+2*h+1, b:b+2*h+1], without
+    # padding the whole image.
+    pad = 5
+    r0, r1 = a, min(a + 2 * h + 1, img.shape[0] + 2 * pad)
+    c0, c1 = b, min(b + 2 * h + 1, img.shape[1] + 2 * pad)
+    U = np.zeros((r1 - r0, c1 - c0), dtype=img.dtype)
+    ir0, ir1 = max(r0, pad), min(r1, img.shape[0] + pad)
+    ic0, ic1 = max(c0, pad), min(c1, img.shape[1] + pad)
+    if ir1 > ir0 and ic1 > ic0:
+        U[ir0 - r0:ir1 - r0, ic0 - c0:ic1 - c0] = img[ir0 - pad:ir1 - pad, ic0 - pad:ic1 - pad]
+    return U
+
+def max_location(img):
+    """First (row-major) location of the maximum, as np.where(img == np.max(img))."""
+    return np.unravel_index(np.argmax(img), img.shape)
+
+
+class SliceContext:
+    """Inputs of the metric functions for one slice.
+
+    Holds the foreground outputs (F, B, c, f, b) and computes the
+    intermediates shared by several metrics (cleaned arrays, their means and
+    standard deviations, the patches around the maxima) on first use, so each
+    is computed at most once per slice.
+    """
+
+    def __init__(self, F, B, c, f, b):
+        self.F = F
+        self.B = B
+        self.c = c
+        self.f = f
+        self.b = b
+
+    @classmethod
+    def from_mask(cls, img, c):
+        ch = np.multiply(c, 1)
+        return cls(ch * img, (1 - ch) * img, c, img[c], img[~c])
+
+    @lazy
+    def f_clean(self):
+        return clean_array(self.f)
+
+    @lazy
+    def b_clean(self):
+        return clean_array(self.b)
+
+    @lazy
+    def F_clean(self):
+        return clean_array(self.F)
+
+    @lazy
+    def fg_mean(self):
+        return np.mean(self.f_clean)
+
+    @lazy
+    def fg_std(self):
+        return np.std(self.f_clean)
+
+    @lazy
+    def bg_mean(self):
+        return np.mean(self.b_clean)
+
+    @lazy
+    def bg_std(self):
+        return np.std(self.b_clean)
+
+    @lazy
+    def fore_max_loc(self):
+        return max_location(self.F)
+
+    @lazy
+    def back_max_loc(self):
+        return max_location(self.B)
+
+    @lazy
+    def fore_patch(self):
+        return patch(self.F, 5, self.fore_max_loc)
+
+    @lazy
+    def back_patch(self):
+        return patch(self.B, 5, self.back_max_loc)
+
+    @lazy
+    def fore_patch_clean(self):
+        return clean_array(self.fore_patch)
+
+    @lazy
+    def back_patch_clean(self):
+        return clean_array(self.back_patch)
+
+
+def call_metric(func, ctx):
+    """Calls a metric with the slice context, or with (F, B, c, f, b) for the older five-argument form."""
+    if metric_arity(func) == 5:
+        return func(ctx.F, ctx.B, ctx.c, ctx.f, ctx.b)
+    return func(ctx)
+
+@lru_cache(maxsize=None)
+def metric_arity(func):
+    return len(inspect.signature(func).parameters)
 
 # Updated metric functions
-def func1(F, B, c, f, b):
+def func1(ctx):
     name = 'MEAN'
-    measure = np.mean(clean_array(f))
+    measure = ctx.fg_mean
     return name, measure
 
-def func2(F, B, c, f, b):
+def func2(ctx):
     name = 'RNG'
-    f = clean_array(f)
-    measure = np.ptp(f)
+    measure = np.ptp(ctx.f_clean)
     return name, measure
 
-def func3(F, B, c, f, b):
+def func3(ctx):
     name = 'VAR'
-    f = clean_array(f)
-    measure = np.var(f)
+    measure = np.var(ctx.f_clean)
     return name, measure
 
-def func4(F, B, c, f, b):
+def func4(ctx):
     name = 'CV'
-    f = clean_array(f)
-    measure = (np.std(f) / np.mean(f)) * 100 if np.mean(f) > 0 else 0
+    measure = (ctx.fg_std / ctx.fg_mean) * 100 if ctx.fg_mean > 0 else 0
     return name, measure
 
-def func5(F, B, c, f, b):
+def func5(ctx):
     name = 'CPP'
     filt = np.array([[-1/8, -1/8, -1/8], [-1/8, 1, -1/8], [-1/8, -1/8, -1/8]])
-    I_hat = conv2(F, filt, mode='same')
+    I_hat = conv2(ctx.F, filt, mode='same')
     measure = np.mean(clean_array(I_hat))
     return name, measure
 
-def func6(F, B, c, f, b):
+def func6(ctx):
     name = 'PSNR'
-    F = clean_array(F)
+    F = ctx.F_clean
     max_val = np.max(F)
     if max_val <= 0:
         measure = 0  # Fallback value for invalid data
     else:
-        I_hat = median(F / max_val, square(5))
+        I_hat = median(F / max_val, np.ones((5, 5), dtype=np.uint8))  # square(5)
         mse = np.mean((F - I_hat) ** 2)
         measure = 20 * np.log10(max_val / (np.sqrt(mse) + 1e-9)) if mse > 0 else 0
     return name, measure
 
-def func7(F, B, c, f, b):
+def func7(ctx):
     name = 'SNR1'
-    f = clean_array(f)
-    b = clean_array(b)
-    bg_std = np.std(b)
-    measure = np.std(f) / (bg_std + 1e-9)
+    measure = ctx.fg_std / (ctx.bg_std + 1e-9)
     return name, measure
 
-def func8(F, B, c, f, b):
+def func8(ctx):
     name = 'SNR2'
-    b = clean_array(b)
-    bg_std = np.std(b)
-    measure = np.mean(patch(F, 5)) / (bg_std + 1e-9)
+    measure = np.mean(ctx.fore_patch) / (ctx.bg_std + 1e-9)
     return name, measure
 
-def func9(F, B, c, f, b):
+def func9(ctx):
     name = 'SNR3'
-    fore_patch = patch(F, 5)
-    fore_patch = clean_array(fore_patch)
+    fore_patch = ctx.fore_patch_clean
     std_diff = np.std(fore_patch - np.mean(fore_patch))
     std_diff = std_diff if std_diff > 0 else 1e-9
     measure = np.mean(fore_patch) / std_diff
     return name, measure
 
-def func10(F, B, c, f, b):
+def func10(ctx):
     name = 'SNR4'
-    fore_patch = patch(F, 5)
-    back_patch = patch(B, 5)
-    fore_patch = clean_array(fore_patch)
-    back_patch = clean_array(back_patch)
-    bg_std = np.std(back_patch)
+    bg_std = np.std(ctx.back_patch_clean)
     bg_std = bg_std if bg_std > 0 else 1e-9
-    measure = np.mean(fore_patch) / bg_std
+    measure = np.mean(ctx.fore_patch_clean) / bg_std
     return name, measure
 
-def func11(F, B, c, f, b):
+def func11(ctx):
     name = 'SNR5'
+    F = ctx.F
     window_size = 5
     local_variance = conv2(F**2, np.ones((window_size, window_size)), mode='valid') / window_size**2 - \
                      (conv2(F, np.ones((window_size, window_size)), mode='valid') / window_size)**2
     local_variance = clean_array(local_variance)
     noise_estimate = np.sqrt(np.mean(local_variance))
-    signal_estimate = np.mean(clean_array(f))
+    signal_estimate = ctx.fg_mean
     measure = signal_estimate / (noise_estimate + 1e-9) if noise_estimate > 0 else 0
     return name, measure
 
-def func15(F, B, c, f, b):
+def func15(ctx):
     name = 'SNR9'
     try:
-        LBP_texture = local_binary_pattern(F, P=8, R=1)
+        LBP_texture = local_binary_pattern(ctx.F, P=8, R=1)
         texture_regions = LBP_texture[(LBP_texture > np.percentile(LBP_texture, 95))]
         if len(texture_regions) == 0:
             noise_estimate = 1e-6
         else:
             noise_estimate = max(np.std(texture_regions), 1e-6)
-        signal_estimate = np.mean(clean_array(f))
+        signal_estimate = ctx.fg_mean
         measure = signal_estimate / noise_estimate
     except Exception:
         measure = 0  # Fallback for LBP errors
     return name, measure
 
-def func16(F, B, c, f, b):
+def func16(ctx):
     name = 'CNR'
-    fore_patch = patch(F, 5)
-    back_patch = patch(B, 5)
-    fore_patch = clean_array(fore_patch)
-    back_patch = clean_array(back_patch)
+    fore_patch = ctx.fore_patch_clean
+    back_patch = ctx.back_patch_clean
     measure = np.mean(fore_patch - back_patch) / (np.std(back_patch) + 1e-6)
     return name, measure
 
-def func17(F, B, c, f, b):
+def func17(ctx):
     name = 'CVP'
-    fore_patch = patch(F, 5)
-    fore_patch = clean_array(fore_patch)
+    fore_patch = ctx.fore_patch_clean
     measure = np.std(fore_patch) / (np.mean(fore_patch) + 1e-6)
     return name, measure
 
-def func18(F, B, c, f, b):
+def func18(ctx):
     name = 'CJV'
-    f = clean_array(f)
-    b = clean_array(b)
-    measure = (np.std(f) + np.std(b)) / abs(np.mean(f) - np.mean(b))
+    measure = (ctx.fg_std + ctx.bg_std) / abs(ctx.fg_mean - ctx.bg_mean)
     return name, measure
 
-def func19(F, B, c, f, b):
+def func19(ctx):
     name = 'EFC'
-    F = clean_array(F)
+    F = ctx.F_clean
     n_vox = F.shape[0] * F.shape[1]
     if n_vox == 0:
         measure = 0  # Fallback for empty images
@@ -188,136 +285,292 @@ def func19(F, B, c, f, b):
         measure = (1.0 / abs(efc_max)) * np.sum((F / b_max) * np.log((F + 1e-16) / b_max))
     return name, measure
 
-def func20(F, B, c, f, b):
+def func20(ctx):
     name = 'FBER'
-    fg_mu = np.median(clean_array(f) ** 2)
-    bg_mu = np.median(clean_array(b) ** 2)
+    fg_mu = np.median(ctx.f_clean ** 2)
+    bg_mu = np.median(ctx.b_clean ** 2)
     measure = fg_mu / (bg_mu + 1e-6) if bg_mu > 1.0e-3 else 0
     return name, measure
 
-def clean_value(number):
-    if isinstance(number, (int, float)):
-        number = '{:.2f}'.format(number)
-        if number.replace(".", "", 1).isdigit():
-            number = float(number)
-            if number % 1 == 0:
-                number = int(number)
-            else:
-                number = round(number, 2)
-    number = np.array(number)
-    return number
-
-
-
-
-def extract_tags(image, tag_data, file_type='dicom', image_shape=None):
-    non_tag_value = 'NA'
-    pre_tags = pd.DataFrame.from_dict(tag_data, orient='index', columns=['Tag Abbreviation']).reset_index()
-    pre_tags = pre_tags.rename(columns={'index': 'Tag Name'})
-    pre_tags['Tag Abbreviation'] = pre_tags['Tag Abbreviation'].apply(lambda x: ','.join(x) if isinstance(x, list) else x)
-    tags = pd.DataFrame(columns=['Tag', 'Value'])
-
-    available_tags = {}
-    if file_type == 'dicom':
-        available_tags = {tag: image.get(tag, non_tag_value) for tag in image.dir()}
-    elif file_type == 'mha' or file_type == 'nifti':
-        available_tags = {tag: image.GetMetaData(tag) for tag in image.GetMetaDataKeys()}
-    elif file_type == 'mat':
-        available_tags = {}  # Add MAT specific metadata extraction here if needed
-
-    for i, row in pre_tags.iterrows():
-        pre_tag = row['Tag Name']
-        pre_tag = pre_tag.replace(" ", "")
-        tag_value = available_tags.get(pre_tag, non_tag_value)
-
-        # Handle specific tags for non-DICOM images
-        if file_type in ['mha', 'nifti']:
-            if pre_tag == "Rows":
-                tag_value = image.GetSize()[1] if tag_value == non_tag_value else tag_value
-            if pre_tag == "Columns":
-                tag_value = image.GetSize()[0] if tag_value == non_tag_value else tag_value
-            if pre_tag == "PixelSpacing":
-                tag_value = list(image.GetSpacing()) if tag_value == non_tag_value else tag_value
-            if pre_tag == "SliceThickness":
-                tag_value = image.GetSpacing()[2] if tag_value == non_tag_value else tag_value
-
-        if tag_value != non_tag_value:
-            tag_value = clean_value(tag_value)
-            tag = row['Tag Abbreviation']
-            mul_tags = tag.split(',')
-            for j, k in enumerate(mul_tags):
-                if np.iterable(tag_value):
-                    tag_value_j = tag_value[j] if j < len(tag_value) else non_tag_value
+# Batched versions of the metrics above, evaluated on a whole stack of slices
+# at once. Metrics without an entry (and any user supplied funcN) are run
+# slice by slice.
+BATCH_METRICS = {
+    func1: batch.mean,
+    func2: batch.rng,
+    func3: batch.var,
+    func4: batch.cv,
+    func5: batch.cpp,
+    func6: batch.psnr,
+    func7: batch.snr1,
+    func8: batch.snr2,
+    func9: batch.snr3,
+    func10: batch.snr4,
+    func11: batch.snr5,
+    func16: batch.cnr,
+    func17: batch.cvp,
+    func18: batch.cjv,
+    func19: batch.efc,
+    func20: batch.fber,
+}
+
+# Volume forms of the metrics above, for --metric-scope volume. The others
+# keep their per-slice values, averaged over the sampled slices.
+VOLUME_METRICS = {
+    func1: volumetric.mean,
+    func2: volumetric.rng,
+    func3: volumetric.var,
+    func4: volumetric.cv,
+    func5: volumetric.cpp,
+    func6: volumetric.psnr,
+    func7: volumetric.snr1,
+    func8: volumetric.snr2,
+    func9: volumetric.snr3,
+    func10: volumetric.snr4,
+    func11: volumetric.snr5,
+    func16: volumetric.cnr,
+    func17: volumetric.cvp,
+    func18: volumetric.cjv,
+    func19: volumetric.efc,
+    func20: volumetric.fber,
+}
+
+def stack_metrics(images, masks, metric_functions, precision='float64', timer=None):
+    """Returns {metric name: per-slice values} for a (n_slices, H, W) stack and its masks.
+
+    With a StageTimer the time of every metric function is recorded under its name.
+    """
+    timer = timer or StageTimer(enabled=False)
+    results = {}
+    for start, stop in batch.chunks(images.shape[0], images[0].size):
+        S = batch.SliceStack(images[start:stop], masks[start:stop], precision)
+        contexts = None
+        for func in metric_functions:
+            with timer.stage(func.__name__):
+                if func in BATCH_METRICS:
+                    name, values = BATCH_METRICS[func](S)
                 else:
-                    tag_value_j = tag_value
-                new_row = {'Tag': k, 'Value': tag_value_j}
-                tags = pd.concat([tags, pd.DataFrame([new_row])], ignore_index=True)
-                
-    return tags
+                    if contexts is None:
+                        contexts = [SliceContext.from_mask(widen(S.images[i]), S.masks[i]) for i in range(S.n)]
+                    values = []
+                    for ctx in contexts:
+                        name, measure = call_metric(func, ctx)
+                        values.append(measure)
+            results.setdefault(name, []).append(np.asarray(values, dtype=np.float64))
+    return {name: np.concatenate(values) for name, values in results.items()}
 
 
+def foreground(img):
+    try:
+        conv_hull = foreground_mask(img)
+        ch = np.multiply(conv_hull, 1)
+        fore_image = ch * img
+        back_image = (1 - ch) * img
+    except Exception: 
+        fore_image = img.copy()
+        back_image = np.zeros_like(img, dtype=np.uint16)
+        conv_hull = np.zeros_like(img, dtype=np.uint16)
+        ch = np.multiply(conv_hull, 1)
+
+    return fore_image, back_image, conv_hull, img[conv_hull], img[conv_hull == False]
+
+
+def sampled_masks(sampled, mask_mode='slice', mask_tolerance=0.02, volume_masks=None):
+    """Foreground masks of a stack of sampled slices.
+
+    Returns the (n_slices, H, W) masks and {k: foreground() outputs} for
+    the slices whose mask could not be computed. In the volume mask mode,
+    volume_masks (a VolumeMasks) masks a stack that is one of several
+    batches of a volume with the thresholds of the whole volume; without
+    it the thresholds are those of the stack.
+    """
+    masks = None
+    irregular = {}
+    if mask_mode == 'volume':
+        try:
+            if volume_masks is not None:
+                masks = volume_masks(sampled)
+            else:
+                masks = volume_foreground_masks(sampled, mask_tolerance)
+        except Exception:
+            masks = None
+    if masks is None:
+        masks = np.empty(sampled.shape, dtype=bool)
+        for k, I in enumerate(sampled):
+            try:
+                masks[k] = foreground_mask(I)
+            except Exception:
+                # foreground() falls back to the whole image, keep its outputs as they are
+                irregular[k] = foreground(widen(I))
+                masks[k] = False
+    return masks, irregular
+
+
+def sampled_metrics(sampled, masks, irregular, metric_functions, precision='float64', timer=None):
+    """stack_metrics of the sampled slices, with the irregular slices of sampled_masks scored on their own."""
+    timer = timer or StageTimer(enabled=False)
+    outputs = stack_metrics(sampled, masks, metric_functions, precision, timer)
+    for k, parts in irregular.items():
+        ctx = SliceContext(*parts)
+        for func in metric_functions:
+            with timer.stage(func.__name__):
+                name, measure = call_metric(func, ctx)
+            outputs[name][k] = measure
+    return outputs
+
+
+def volume_metrics(images, metric_functions, scan_type='MRI', mask_mode='slice', mask_tolerance=0.02,
+                   precision='float64', timer=None, thresholds=None):
+    """{metric name: value} over every slice of a (n_slices, H, W) volume, for the metrics in VOLUME_METRICS.
+
+    The slices are read and masked in chunks, each once; see volumetric.py.
+    In the volume mask mode the chunks are masked with thresholds (a
+    VolumeThresholds), by default those of the whole volume.
+    """
+    timer = timer or StageTimer(enabled=False)
+    if mask_mode == 'volume' and thresholds is None:
+        thresholds = volume_thresholds(images, range(images.shape[0]), scan_type, timer, release=True)
+    volume_masks = VolumeMasks(thresholds, mask_tolerance) if mask_mode == 'volume' else None
+    functions = [func for func in metric_functions if func in VOLUME_METRICS]
+    needs = {volumetric.NEEDS[VOLUME_METRICS[func]] for func in functions if VOLUME_METRICS[func] in volumetric.NEEDS}
+    stats = volumetric.VolumeStats(needs, precision)
+    n_slices = images.shape[0]
+    chunk, chunk_masks, chunk_start = None, None, 0
+    for start, stop in batch.chunks(n_slices, int(np.prod(images.shape[1:]))):
+        lo, hi = max(start - volumetric.HALO, 0), min(stop + volumetric.HALO, n_slices)
+        # the slices already read for the previous chunk are its context here
+        read_from = lo if chunk is None else chunk_start + len(chunk)
+        if read_from < hi:
+            with timer.stage('pixel_decode'):
+                new = np.asarray(images[read_from:hi])
+            if scan_type == 'CT':
+                new = np.stack([shift_to_zero(I) for I in new])
+            with timer.stage('foreground'):
+                new_masks, _ = sampled_masks(new, mask_mode, mask_tolerance, volume_masks)
+            if chunk is not None:
+                new = np.concatenate([chunk[lo - chunk_start:], new])
+                new_masks = np.concatenate([chunk_masks[lo - chunk_start:], new_masks])
+            chunk, chunk_masks = new, new_masks
+        else:
+            chunk, chunk_masks = chunk[lo - chunk_start:], chunk_masks[lo - chunk_start:]
+        chunk_start = lo
+        if isinstance(images, LazyVolume):
+            images.release(lo)
+        with timer.stage('volume_metrics'):
+            stats.add(chunk, chunk_masks, start - lo, stop - lo)
+    return dict(VOLUME_METRICS[func](stats) for func in functions)
+
+
+def volume_thresholds(images, indices, scan_type='MRI', timer=None, release=False):
+    """VolumeThresholds of the slices indices of a volume, read one at a time.
+
+    With release the decoded slices of a LazyVolume are dropped as soon as
+    they are counted, so the volume is never held whole.
+    """
+    timer = timer or StageTimer(enabled=False)
+    thresholds = VolumeThresholds()
+    for j in indices:
+        with timer.stage('pixel_decode'):
+            I = images[j]
+        if scan_type == 'CT':
+            I = shift_to_zero(I)
+        with timer.stage('foreground'):
+            thresholds.add(I)
+        if release and isinstance(images, LazyVolume):
+            images.release(j + 1)
+    return thresholds
+
+
+def coarse_window(images, indices, timer=None, release=False):
+    """coarse_slices of the slices indices of a volume, {index: blocks}, read one at a time.
+
+    With release the decoded slices of a LazyVolume are dropped as soon as
+    they are reduced.
+    """
+    timer = timer or StageTimer(enabled=False)
+    coarse = {}
+    for j in indices:
+        with timer.stage('pixel_decode'):
+            I = images[j]
+        with timer.stage('prescreen'):
+            coarse[j] = coarse_slices(I[None])[0]
+        if release and isinstance(images, LazyVolume):
+            images.release(j + 1)
+    return coarse
+
+
+def metric_functions():
+    """The funcN metrics of this module, in the order of N."""
+    functions = [func for name, func in inspect.getmembers(sys.modules[__name__]) if name.startswith('func')]
+    return sorted(functions, key=lambda f: int(re.search(r'\d+', f.__name__).group()))
 
 
+def middle_slices(n_slices, middle_size=100):
+    """The indices of the middle middle_size percent of n_slices slices."""
+    middle_index = n_slices // 2
+    slices_to_include = int(middle_size * 0.01 * n_slices / 2)
+    return range(n_slices)[middle_index - slices_to_include: middle_index + slices_to_include]
 
-def input_data(root):
-    files = [str(Path(dirpath) / filename) for dirpath, _, filenames in os.walk(root)
-             for filename in filenames
-             if filename.endswith(('.dcm', '.mha', '.nii', '.gz', '.mat'))]
+def extract_subject_id(filename):
+    subject_id = Path(filename).stem
+    if subject_id.endswith('.nii'):  # For files like .nii.gz
+        subject_id = subject_id[:-4]
+    return subject_id.split('.')[0]
+
+
+def input_data(root, io_threads=16, catalog=None):
+    if catalog is not None:
+        file_stats = scan_files(root)
+        files = list(file_stats)
+    else:
+        files = [str(Path(dirpath) / filename) for dirpath, _, filenames in os.walk(root)
+                 for filename in filenames
+                 if filename.endswith(IMAGE_EXTENSIONS)]
 
     dicom_files = [i for i in files if i.endswith('.dcm')]
     mha_files = [i for i in files if i.endswith('.mha')]
     nifti_files = [i for i in files if i.endswith('.nii') or i.endswith('.gz')]
     mat_files = [i for i in files if i.endswith('.mat')]
 
-    def extract_subject_id(filename):
-        subject_id = Path(filename).stem
-        if subject_id.endswith('.nii'):  # For files like .nii.gz
-            subject_id = subject_id[:-4]
-        return subject_id.split('.')[0]
-
-    # Extract PatientID and construct file-based unique identifier
-    dicom_pre_subjects = []
-    dicom_combined_subjects = []
+    if catalog is not None:
+        headers = catalog.refresh(file_stats, io_threads)
+        dicom_headers = [headers[dicom_file] for dicom_file in dicom_files]
+    else:
+        dicom_headers = read_dicom_headers(dicom_files, io_threads)
 
-    for dicom_file in dicom_files:
-        try:
-            dcm_data = pydicom.dcmread(dicom_file)
-            patient_id = dcm_data.get("PatientID", "Unknown").strip()
-            dicom_pre_subjects.append(patient_id)
-            file_name = Path(dicom_file).stem
-            dicom_combined_subjects.append(f"{file_name}_{patient_id}")
-        except Exception as e:
-            print(f"Could not read DICOM file: {dicom_file}. Error: {e}")
-            dicom_pre_subjects.append("Unknown")
-            dicom_combined_subjects.append(f"{Path(dicom_file).stem}_Unknown")
+    # One participant per DICOM series, with its files in slice order
+    dicom_series = group_dicom_series(dicom_files, dicom_headers)
+    dicom_subjects = list(dicom_series.keys())
+    dicom_splits = list(dicom_series.values())
 
     mhas_subjects = [extract_subject_id(scan) for scan in mha_files]
     nifti_subjects = [extract_subject_id(scan) for scan in nifti_files]
     mat_subjects = [extract_subject_id(scan) for scan in mat_files]
 
-    duplicateFrequencies_dicom = Counter(dicom_combined_subjects)
-    dicom_subjects = list(duplicateFrequencies_dicom.keys())
-
-    dicom_scan_numbers = list(duplicateFrequencies_dicom.values())
-    ind = [0] + list(accumulate(dicom_scan_numbers))
-    dicom_splits = [dicom_files[ind[i]:ind[i+1]] for i in range(len(ind)-1)]
-
     subjects_id = dicom_subjects + mhas_subjects + nifti_subjects + mat_subjects
 
+    # subject -> type and subject -> path; the first listed type and file of
+    # a subject wins, as in a scan of the lists in this order.
+    subject_types = {}
+    subject_paths = {}
+    for subject, path in zip(dicom_subjects, dicom_splits):
+        subject_types.setdefault(subject, 'dicom')
+        subject_paths.setdefault(('dicom', subject), path)
+    for subject_type, subjects, paths in (('mha', mhas_subjects, mha_files),
+                                          ('nifti', nifti_subjects, nifti_files),
+                                          ('mat', mat_subjects, mat_files)):
+        for subject, path in zip(subjects, paths):
+            subject_types.setdefault(subject, subject_type)
+            subject_paths.setdefault((subject_type, subject), path)
+
     data = {'subject_id': subjects_id, 
-            'subject_type': ['dicom' if subject in dicom_subjects 
-                             else 'mha' if subject in mhas_subjects 
-                             else 'nifti' if subject in nifti_subjects 
-                             else 'mat' for subject in subjects_id]}
+            'subject_type': [subject_types[subject] for subject in subjects_id]}
+    import pandas as pd
     df = pd.DataFrame(data)
-    df['dicom_splits'] = [dicom_splits[dicom_subjects.index(subject)] if subject in dicom_subjects else None for subject in df['subject_id']]
-    df['path'] = [path if subject_type == 'dicom' else
-                  next((mha for mha in mha_files if extract_subject_id(mha) == subject), None) if subject_type == 'mha' else
-                  next((nifti for nifti in nifti_files if extract_subject_id(nifti) == subject), None) if subject_type == 'nifti' else
-                  next((mat for mat in mat_files if extract_subject_id(mat) == subject), None) if subject_type == 'mat' else
-                  None
-                  for path, subject, subject_type in zip(df['dicom_splits'], df['subject_id'], df['subject_type'])]
-    df.drop('dicom_splits', axis=1, inplace=True)
+    df['path'] = [subject_paths.get((subject_type, subject))
+                  for subject, subject_type in zip(df['subject_id'], df['subject_type'])]
+    if catalog is not None:
+        catalog.set_subjects(df['subject_id'], df['subject_type'], df['path'])
 
     print(f'The number of participants is {len(df)}.')
     return df
@@ -326,53 +579,36 @@ def input_data(root):
 
 
 
-def volume(name, scans, subject_type, tag_data, middle_size=100):
+def volume(name, scans, subject_type, tag_plan, middle_size=100, rescale=False):
     volumes = []
     if subject_type == 'dicom':
         scans = scans[int(0.005 * len(scans) * (100 - middle_size)):int(0.005 * len(scans) * (100 + middle_size))]
-        inf = pydicom.dcmread(scans[0])
-        tags = extract_tags(inf, tag_data, file_type='dicom')
-        
-        # Convert tags to DataFrame if it's not already
-        if isinstance(tags, dict):
-            tags = pd.DataFrame.from_dict(tags, orient='index', columns=['Value']).reset_index()
-            tags.rename(columns={'index': 'Tag'}, inplace=True)
-        
-        first_row = {'Tag': 'Participant ID', 'Value': f"{name}"}
-        tags.loc[-1] = first_row
-        tags.index = tags.index + 1
-        tags = tags.sort_index()
-
-        slices = [pydicom.dcmread(s) for s in scans]
-        slices.sort(key=lambda x: int(x.InstanceNumber) if x.InstanceNumber is not None else 0)
-        images = np.stack([s.pixel_array for s in slices])
-        images = images.astype(np.int64)
-        volumes.append((images, tags))
+        import pydicom
+        inf = pydicom.dcmread(scans[0], stop_before_pixels=True, specific_tags=tag_plan.dicom_tags)
+        tags = {'Participant ID': f"{name}", **tag_plan.extract(inf, file_type='dicom')}
+
+        # input_data lists the files of a series in slice order; slices
+        # are decoded when IQM samples them
+        volumes.append((dicom_volume(scans, rescale), tags))
     elif subject_type in ['mha', 'nifti']:
-        image = sitk.ReadImage(scans)
-        image_array = sitk.GetArrayFromImage(image)
-        tags = extract_tags(image, tag_data, file_type=subject_type, image_shape=image_array.shape)
-        
-        # Convert tags to DataFrame if it's not already
-        if isinstance(tags, dict):
-            tags = pd.DataFrame.from_dict(tags, orient='index', columns=['Value']).reset_index()
-            tags.rename(columns={'index': 'Tag'}, inplace=True)
-        
-        images = [image_array[i, :, :] for i in range(image_array.shape[0])]
-        middle_index = len(images) // 2
-        slices_to_include = int(middle_size * 0.01 * len(images) / 2)
-        images = images[middle_index - slices_to_include: middle_index + slices_to_include]
-        images = np.stack(images, axis=0)
+        import SimpleITK as sitk
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(scans)
+        reader.ReadImageInformation()
+        n_slices = reader.GetSize()[2] if reader.GetDimension() > 2 else 1
+        tags = tag_plan.extract(reader, file_type=subject_type)
+
+        slice_indices = middle_slices(n_slices, middle_size)
+        # A view of the middle window when the voxel data can be mapped or
+        # streamed directly, otherwise SimpleITK extract regions.
+        images = stream_volume(scans, slice_indices.start, slice_indices.stop)
+        if images is None:
+            images = sitk_volume(reader, slice_indices)
         volumes.append((images, tags))
     elif subject_type == 'mat':
         images = loadmat(scans)['vol']
-        tags = extract_tags(images, tag_data, file_type=subject_type, image_shape=images.shape)
-        
-        # Convert tags to DataFrame if it's not already
-        if isinstance(tags, dict):
-            tags = pd.DataFrame.from_dict(tags, orient='index', columns=['Value']).reset_index()
-            tags.rename(columns={'index': 'Tag'}, inplace=True)
-        
+        tags = tag_plan.extract(images, file_type=subject_type)
+
         middle_index = len(images) // 2
         slices_to_include = int(middle_size * 0.01 * len(images) / 2)
         images = images[middle_index - slices_to_include: middle_index + slices_to_include]
@@ -383,11 +619,17 @@ def volume(name, scans, subject_type, tag_data, middle_size=100):
 
 class IQM(dict):
 
-    def __init__(self, v, participant, total_participants, participant_index, subject_type, total_tags, metric_functions):
+    def __init__(self, v, participant, total_participants, participant_index, subject_type, total_tags, metric_functions, settings, timer=None):
         print(f'-------------- Participant {participant_index} out of {total_participants} with the {subject_type} type: {participant} --------------')
         dict.__init__(self)
+        timer = timer or StageTimer(enabled=False)
         self["warnings"] = [] 
         self["output"] = []
+        fname_outdir = settings['fname_outdir']
+        sample_size = settings['sample_size']
+        scan_type = settings['scan_type']
+        save_masks_flag = settings['save_masks_flag']
+        mask_mode = settings.get('mask_mode', 'slice')
         directory_path = Path(fname_outdir) / participant
         if save_masks_flag != False: 
             maskfolder = Path(fname_outdir / 'foreground_masks')
@@ -398,11 +640,11 @@ class IQM(dict):
         for volume_data in v:
             if isinstance(volume_data, tuple) and len(volume_data) == 2:
                 total_metrics = total_tags + len(metric_functions) + 2  # + 1 for NUM + 1 for INS
+                if settings.get('empty_slices', 'keep') != 'keep':
+                    total_metrics += 1  # EMPTY
                 images = volume_data[0]
                 tags = volume_data[1]
-                for idx, row in tags.iterrows():
-                    metric = row['Tag']
-                    value = row['Value']
+                for metric, value in tags.items():
                     self.addToPrintList(count, participant, metric, value, total_metrics)
                     count += 1
             else:
@@ -410,41 +652,136 @@ class IQM(dict):
                 images = volume_data
                 count = 0
 
-        participant_scan_number = int(np.ceil(images.shape[0] / sample_size))
-        self["participant_scan_number"] = participant_scan_number 
         self["os_handle"] = images      
-        outputs_list = []
-        for j in range(0, images.shape[0], sample_size):
-            I = images[j, :, :]
-            folder = Path(fname_outdir)
-            self.save_image(participant, I, j, folder)
-            if scan_type == "CT": 
-                I = I - np.min(I)  # Apply intensity adjustment only for CT scans 
-            F, B, c, f, b = self.foreground(I)
+        indices = list(range(0, images.shape[0], sample_size))
+        image_names = []
+        volume_scope = settings.get('metric_scope', 'slice') == 'volume'
+        # --mask-mode volume: the Otsu thresholds come from the histogram of
+        # all sampled slices (every slice of the window for --metric-scope
+        # volume), counted before any is masked, so they do not depend on
+        # the chunks or --adaptive batches the slices are masked in
+        thresholds = None
+        if mask_mode == 'volume':
+            counted = range(images.shape[0]) if volume_scope else indices
+            thresholds = volume_thresholds(images, counted, scan_type, timer, release=volume_scope)
+        if volume_scope:
+            # One value per metric over every slice of the middle window
+            per_slice = [func for func in metric_functions if func not in VOLUME_METRICS]
+            whole = volume_metrics(images, metric_functions, scan_type, mask_mode, settings.get('mask_tolerance', 0.02),
+                                   settings.get('precision', 'float64'), timer, thresholds)
+        else:
+            per_slice = metric_functions
+            whole = {}
+
+        # Slices with almost no 4x4 blocks above the air level of the
+        # sampled slices, found before their thumbnails, masks and metrics.
+        # The level comes from every candidate slice before any is scored,
+        # so it does not depend on the --adaptive batches.
+        empty_policy = settings.get('empty_slices', 'keep')
+        empty_count = 0
+        if empty_policy != 'keep':
+            coarse = coarse_window(images, indices, timer, release=volume_scope)
+            with timer.stage('prescreen'):
+                level = signal_level(np.stack(list(coarse.values())))
+        volume_masks = VolumeMasks(thresholds, settings.get('mask_tolerance', 0.02)) if thresholds is not None else None
+
+        def score(slices):
+            nonlocal empty_count
+            raw = []
+            for j in slices:
+                with timer.stage('pixel_decode'):
+                    raw.append(images[j])
+            empty = np.zeros(len(slices), dtype=bool)
+            if empty_policy != 'keep':
+                with timer.stage('prescreen'):
+                    empty = empty_slices(np.stack([coarse[j] for j in slices]), level,
+                                         settings.get('empty_fraction', 0.01))
+                empty_count += int(empty.sum())
+            kept = [k for k in range(len(slices)) if not (empty_policy == 'skip' and empty[k])]
+            if not kept and not visited:
+                # nothing but air so far: score it rather than leave the row empty
+                kept = list(range(len(slices)))
+            sampled = []
+            for k in kept:
+                I = raw[k]
+                folder = Path(fname_outdir)
+                with timer.stage('thumbnails'):
+                    image_names.append(self.save_image(participant, I, slices[k], folder, thumbnails))
+                if scan_type == "CT": 
+                    I = shift_to_zero(I)  # Apply intensity adjustment only for CT scans 
+                sampled.append(I)
+            visited.extend(slices[k] for k in kept)
+            flags.extend(empty[kept])
+            if not kept:
+                return {}
+            sampled = np.stack(sampled)
+
+            with timer.stage('foreground'):
+                masks, irregular = sampled_masks(sampled, mask_mode, settings.get('mask_tolerance', 0.02), volume_masks)
             if save_masks_flag != False: 
-                self.save_image(participant, c, j, maskfolder)
-                
-            outputs = {}
-            for func in metric_functions:
-                name, measure = func(F, B, c, f, b)
-                outputs[name] = measure
-            outputs_list.append(outputs)
+                with timer.stage('thumbnails'):
+                    for k, j in enumerate(slices[k] for k in kept):
+                        c = irregular[k][2] if k in irregular else masks[k]
+                        self.save_image(participant, c, j, maskfolder, thumbnails)
+            return sampled_metrics(sampled, masks, irregular, per_slice, settings.get('precision', 'float64'), timer)
+
+        visited, flags, parts = [], [], []
+        # PNGs are encoded and written in the background while the masks
+        # and metrics are computed; a failure cancels the pending ones
+        with ThumbnailWriter(settings.get('thumb_size'), layout=settings.get('thumb_layout', 'files')) as thumbnails:
+            if settings.get('adaptive') is not None:
+                # Slices in stratified order until the means of all metrics are
+                # known to the requested tolerance
+                sampler = AdaptiveSampler(indices, settings['adaptive'], settings.get('confidence', 0.95),
+                                          settings.get('adaptive_metrics'))
+                for slices in iter(sampler.next_batch, []):
+                    parts.append(score(slices))
+                    sampler.add(parts[-1])
+                print(f'{participant}: {sampler.status()}.')
+            else:
+                parts.append(score(indices))
+            with timer.stage('thumbnails'):
+                thumbnails.close()
+        order = np.argsort(visited, kind='stable')
+        indices = [visited[k] for k in order]
+        image_names = [image_names[k] for k in order]
+        flags = np.asarray(flags, dtype=bool)[order]
+        names = next((list(part) for part in parts if part), [])
+        outputs = {name: np.concatenate([part[name] for part in parts if part])[order] for name in names}
+        participant_scan_number = len(indices)
+        self["participant_scan_number"] = participant_scan_number 
+        # time the pool threads spent encoding and writing, beside the main thread
+        timer.add('thumbnail_encode', thumbnails.busy)
+        # Per-slice values for the columnar output; not a results.tsv column
+        self["slice_metrics"] = {"Slice": indices, **outputs}
+        if empty_policy != 'keep':
+            self["slice_metrics"]["Empty"] = flags
         print(f'The number of {participant_scan_number} scans were saved to {fname_outdir / participant} directory.')
         if save_masks_flag != False: 
             print(f'The number of {participant_scan_number} masks were also saved to {maskfolder / participant} directory.')
         
-        self.addToPrintList(1, participant, "Name of Images", os.listdir(directory_path), 25)
+        self.addToPrintList(1, participant, "Name of Images", image_names, 25)
         # count += 1
         self.addToPrintList(count, participant, "NUM", participant_scan_number, total_metrics)
+        if empty_policy != 'keep':
+            count += 1
+            self.addToPrintList(count, participant, "EMPTY", empty_count, total_metrics)
+        # downweight: the empty slices count --empty-weight times as much as the others
+        weights = np.where(flags, settings.get('empty_weight', 0.1), 1.0) if empty_policy == 'downweight' else None
         averages = {}
-        for key in outputs_list[0].keys():
-            values = [dic[key] for dic in outputs_list]
-            averages[key] = np.mean(values) 
+        slice_values, volumetric_values = iter(outputs.items()), iter(whole.items())
+        for func in metric_functions:
+            if whole and func in VOLUME_METRICS:
+                key, value = next(volumetric_values)
+                averages[key] = value
+            else:
+                key, values = next(slice_values)
+                averages[key] = np.average(values, weights=weights) if weights is not None else np.mean(values)
             count += 1
             self.addToPrintList(count, participant, key, averages[key], total_metrics)
 
     
-    def save_image(self, participant, I, index, folder):
+    def save_image(self, participant, I, index, folder, thumbnails):
         # Ensure the folder exists
         participant_dir = folder / participant
         participant_dir.mkdir(parents=True, exist_ok=True)
@@ -455,37 +792,16 @@ class IQM(dict):
         elif I.ndim != 2:
             raise ValueError(f"Unsupported image shape: {I.shape}. Expected 2D grayscale or 3D RGB/RGBA.")
     
-        # Save the image
+        # Queue the image; the writer owns it from here
         filename = f"{participant}({index}).png"
         image_path = participant_dir / filename
-        plt.imsave(image_path, I, cmap=cm.Greys_r)
+        thumbnails.submit(image_path, I)
+        return filename
 
 
 
     def foreground(self, img):
-        try:
-            h = ex.equalize_hist(img[:, :]) * 255
-            oi = np.zeros_like(img, dtype=np.uint16)
-            oi[(img > threshold_otsu(img)) == True] = 1
-            oh = np.zeros_like(img, dtype=np.uint16)
-            oh[(h > threshold_otsu(h)) == True] = 1
-            nm = img.shape[0] * img.shape[1]
-            w1 = np.sum(oi) / nm
-            w2 = np.sum(oh) / nm
-            ots = np.zeros_like(img, dtype=np.uint16)
-            new = (w1 * img) + (w2 * h)
-            ots[(new > threshold_otsu(new)) == True] = 1 
-            conv_hull = convex_hull_image(ots)
-            ch = np.multiply(conv_hull, 1)
-            fore_image = ch * img
-            back_image = (1 - ch) * img
-        except Exception: 
-            fore_image = img.copy()
-            back_image = np.zeros_like(img, dtype=np.uint16)
-            conv_hull = np.zeros_like(img, dtype=np.uint16)
-            ch = np.multiply(conv_hull, 1)
-
-        return fore_image, back_image, conv_hull, img[conv_hull], img[conv_hull == False]
+        return foreground(img)
 
     def addToPrintList(self, count, participant, metric, value, total_metrics):
         self[metric] = value
@@ -499,21 +815,88 @@ class IQM(dict):
 
     
 
-def worker_callback(s, fname_outdir):
-    global csv_report, first, nfiledone
-    if nfiledone == 0:
-        csv_report = open(Path(fname_outdir) / "results.tsv", overwrite_flag, buffering=1)
-        first = True
-
-    if first and overwrite_flag == "w":
-        first = False
-        csv_report.write("\n".join(["#" + s for s in headers]) + "\n")
-        csv_report.write("#dataset:" + "\n")
-        csv_report.write("\t".join(s["output"]) + "\n")
+class ResultWriter:
+    """Single writer for results.tsv.
+
+    Rows arrive tagged with the participant index. With ``ordered=True`` they
+    are buffered until every earlier participant has been written, otherwise
+    they are written in completion order. The header block is written once.
+    Every row written is also appended to ``table`` (a ResultTable) when
+    one is given. With ``atomic=True`` the rows go to a .partial file that
+    replaces ``path`` on close(), so an interrupted run leaves the previous
+    results in place.
+    """
+
+    def __init__(self, path, headers, overwrite_flag="w", ordered=True, table=None, atomic=False):
+        self.path = path
+        self.partial = Path(str(path) + '.partial') if atomic else None
+        self.csv_report = open(self.partial or path, overwrite_flag, buffering=1)
+        self.headers = headers
+        self.first = overwrite_flag == "w"
+        self.ordered = ordered
+        self.pending = {}
+        self.next_index = 0
+        self.nfiledone = 0
+        self.table = table
+
+    def write(self, index, s):
+        if not self.ordered:
+            self._write_row(s)
+            return
+        self.pending[index] = s
+        while self.next_index in self.pending:
+            self._write_row(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def _write_row(self, s):
+        if self.first:
+            self.first = False
+            self.csv_report.write("\n".join(["#" + h for h in self.headers]) + "\n")
+            self.csv_report.write("#dataset:" + "\n")
+            self.csv_report.write("\t".join(s["output"]) + "\n")
+
+        self.csv_report.write("\t".join([str(s[field]) for field in s["output"]]) + "\n")
+        self.csv_report.flush()
+        if self.table is not None:
+            self.table.append(s)
+        self.nfiledone += 1
+
+    def close(self, commit=True):
+        # Anything still pending belongs after a participant that never
+        # arrived; keep it rather than dropping rows.
+        for index in sorted(self.pending):
+            self._write_row(self.pending.pop(index))
+        self.csv_report.close()
+        if self.partial is not None:
+            if commit:
+                os.replace(self.partial, self.path)
+            else:
+                os.remove(self.partial)
+
+
+def process_participant(participant_index, total_participants, name, scans, subject_type, tag_plan, total_tags, functions, settings):
+    warnings.filterwarnings("ignore")
+    timer = StageTimer(name, enabled=settings.get('timings', False))
+    profile = settings.get('profile') == name
+    with profiled(Path(settings['fname_outdir']) / f"profile_{name}", settings.get('profiler', 'cprofile')) if profile else nullcontext():
+        with timer.stage('participant'):
+            # volume() reads the header; the pixels are decoded as IQM samples them
+            with timer.stage('header_read'):
+                v = volume(name, scans, subject_type, tag_plan, settings['middle_size'], settings.get('rescale', False))
+            try:
+                s = IQM(v, name, total_participants, participant_index, subject_type, total_tags, functions, settings, timer)
+            finally:
+                # open .nii.gz streams of the volume, also when scoring failed
+                for volume_data in v:
+                    images = volume_data[0] if isinstance(volume_data, tuple) else volume_data
+                    if isinstance(images, LazyVolume):
+                        images.close()
+    # The volume is not needed once the metrics are computed and would
+    # otherwise be pickled back from pool workers.
+    s.pop("os_handle", None)
+    s["timings"] = timer.records()
+    return s
 
-    csv_report.write("\t".join([str(s[field]) for field in s["output"]]) + "\n")
-    csv_report.flush()
-    nfiledone += 1
 
 def print_msg_box(msg, indent=1, width=None, title=None):
     lines = msg.split('\n')
@@ -529,15 +912,56 @@ def print_msg_box(msg, indent=1, width=None, title=None):
     print(box)   
 
 
-def main(args):
-    global save_masks_flag, sample_size, middle_size, scan_type, fname_outdir, overwrite_flag, headers
+def run_settings(args, fname_outdir):
+    """The settings every participant is processed with, from the command line arguments."""
+    return {'fname_outdir': fname_outdir, 'sample_size': args.b, 'middle_size': args.u,
+            'scan_type': args.t, 'save_masks_flag': args.s,
+            'mask_mode': getattr(args, 'mask_mode', 'slice'), 'mask_tolerance': getattr(args, 'mask_tolerance', 0.02),
+            'precision': getattr(args, 'precision', 'float64'), 'rescale': getattr(args, 'rescale', False),
+            'thumb_size': getattr(args, 'thumb_size', None), 'thumb_layout': getattr(args, 'thumb_layout', 'files'),
+            'timings': getattr(args, 'timings', False), 'profile': getattr(args, 'profile', None),
+            'profiler': getattr(args, 'profiler', 'cprofile'),
+            'timeseries': getattr(args, 'timeseries', False), 'time_batch': getattr(args, 'time_batch', 8),
+            'metric_scope': getattr(args, 'metric_scope', 'slice'),
+            'adaptive': getattr(args, 'adaptive', None), 'confidence': getattr(args, 'confidence', 0.95),
+            'adaptive_metrics': getattr(args, 'adaptive_metrics', None),
+            'empty_slices': getattr(args, 'empty_slices', 'keep'), 'empty_fraction': getattr(args, 'empty_fraction', 0.01),
+            'empty_weight': getattr(args, 'empty_weight', 0.1)}
+
+
+def load_tag_plan(scan_type):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    tag_filename = "MRI_TAGS.yaml" if scan_type == "MRI" else "CT_TAGS.yaml"
+    tag_path = os.path.join(script_dir, tag_filename)
+    with open(tag_path, 'rb') as file:
+        tag_data = yaml.safe_load(file)
+    return TagPlan(tag_data)
+
 
+def count_tags(tag_plan, subject_type, path):
+    """Number of tag columns of a participant of this type (path is not needed for DICOM)."""
+    if subject_type == 'dicom':
+        return tag_plan.n_tags
+    # The tags come from the header, the voxel data is not needed
+    import SimpleITK as sitk
+    sample_image = sitk.ImageFileReader()
+    sample_image.SetFileName(path)
+    sample_image.ReadImageInformation()
+    return len(tag_plan.extract(sample_image, file_type=subject_type))
+
+
+def main(args):
+    start_time = time.time()
+    warnings.filterwarnings("ignore")
     root = args.inputdir[0] if isinstance(args.inputdir, list) else args.inputdir
     save_masks_flag = args.s
     sample_size = args.b
     middle_size = args.u
     scan_type = args.t
     overwrite_flag = "w"
+    workers = getattr(args, 'workers', 1) or 1
+    ordered = getattr(args, 'order', 'input') == 'input'
+    headers = []
 
     print(f'RadQy for the {scan_type} data is starting....')
 
@@ -547,49 +971,119 @@ def main(args):
     fname_outdir = print_forlder_note / 'Data' / output_folder_name
     headers.append(f"outdir:\t{Path(fname_outdir).resolve()}")
     headers.append(f"scantype:\t{scan_type}")
-
-    df = input_data(root)
+    settings = run_settings(args, fname_outdir)
+    timer = StageTimer(enabled=settings['timings'])
+    timings = []
+
+    Path(fname_outdir).mkdir(parents=True, exist_ok=True)
+    catalog = None if getattr(args, 'no_catalog', False) else Catalog(Path(fname_outdir) / 'catalog.sqlite')
+    with timer.stage('discovery'):
+        df = input_data(root, getattr(args, 'io_threads', 16), catalog)
+    if catalog is not None:
+        catalog.close()
+    process = process_participant
+    if settings['timeseries']:
+        # 4D series are read from NIfTI and MetaImage files only
+        from .timeseries import process_timeseries
+        process = process_timeseries
+        series = df['subject_type'].isin(['nifti', 'mha'])
+        if not series.all():
+            print(f'{(~series).sum()} DICOM or MAT participants are skipped in the time-series mode.')
+        df = df[series].reset_index(drop=True)
+        if df.empty:
+            print('There are no NIfTI or MetaImage series to score.')
+            return
     total_participants = len(df)
 
-    functions = [func for name, func in inspect.getmembers(sys.modules[__name__]) if name.startswith('func')]
-    functions = sorted(functions, key=lambda f: int(re.search(r'\d+', f.__name__).group()))
+    functions = metric_functions()
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    # Compiled once; every participant runs the same plan against its header
+    tag_plan = load_tag_plan(scan_type)
     if 'dicom' in df['subject_type'].values:
-        tag_filename = "MRI_TAGS.yaml" if scan_type == "MRI" else "CT_TAGS.yaml"
-        tag_path = os.path.join(script_dir, tag_filename)
-        with open(tag_path, 'rb') as file:
-            tag_data = yaml.safe_load(file)
-        total_tags = sum(len(value) if isinstance(value, list) else 1 for value in tag_data.values())
+        total_tags = count_tags(tag_plan, 'dicom', None)
     else:
-        tag_filename = "MRI_TAGS.yaml" if scan_type == "MRI" else "CT_TAGS.yaml"
-        tag_path = os.path.join(script_dir, tag_filename)
-        with open(tag_path, 'rb') as file:
-            tag_data = yaml.safe_load(file)
-        sample_image = sitk.ReadImage(df['path'][0])
-        sample_tags = extract_tags(sample_image, tag_data, file_type=df['subject_type'][0], image_shape=sitk.GetArrayFromImage(sample_image).shape)
-        total_tags = len(sample_tags)
+        total_tags = count_tags(tag_plan, df['subject_type'][0], df['path'][0])
+
+    if settings['adaptive_metrics']:
+        from .api import metric_table
+        unknown = [name for name in settings['adaptive_metrics'] if name not in metric_table()]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown} in --adaptive-metrics; available: {list(metric_table())}")
+
+    columnar = getattr(args, 'columnar', None)
+    if columnar:
+        require_pyarrow()
+    # Every scored participant goes to checkpoint.jsonl as it finishes; with
+    # --resume the participants whose input files and settings are unchanged
+    # keep their stored rows and only the others are scored.
+    resume = getattr(args, 'resume', False)
+    checkpoint = Checkpoint(Path(fname_outdir) / 'checkpoint.jsonl')
+    digests = [fingerprint(df['path'][i], settings) for i in range(total_participants)]
+    reused = {}
+    if resume:
+        stored = checkpoint.load()
+        for i in range(total_participants):
+            entry = stored.get(df['subject_id'][i])
+            if entry is not None and entry[0] == digests[i]:
+                reused[i] = entry[1]
+        print(f'{len(reused)} participants are unchanged since the last run, {total_participants - len(reused)} will be scored.')
+    checkpoint.rewrite([(df['subject_id'][i], digests[i], row) for i, row in reused.items()])
+    checkpoint.open()
+
+    table = ResultTable(Path(fname_outdir), columnar)
+    writer = ResultWriter(Path(fname_outdir) / "results.tsv", headers, overwrite_flag, ordered=ordered, table=table,
+                          atomic=resume)
+    jobs = [(i, (i + 1, total_participants, df['subject_id'][i], df['path'][i], df['subject_type'][i],
+                 tag_plan, total_tags, functions, settings))
+            for i in range(total_participants) if i not in reused]
+
+    def finished(i, s):
+        nonlocal total_scans
+        total_scans += s.get_participant_scan_number()
+        timings.extend(s.pop("timings", []))
+        if i not in reused:
+            checkpoint.append(df['subject_id'][i], digests[i], s)
+        with timer.stage('results_write'):
+            writer.write(i, s)
 
     total_scans = 0
-    for i in range(total_participants):
-        participant_index = i + 1
-        name = df['subject_id'][i]
-        scans = df['path'][i]
-        subject_type = df['subject_type'][i]
-        v = volume(name, scans, subject_type, tag_data)
-        s = IQM(v, name, total_participants, participant_index, subject_type, total_tags, functions)
-        total_scans += s.get_participant_scan_number()
-        worker_callback(s, fname_outdir)
+    try:
+        for i, row in reused.items():
+            finished(i, row)
+        if workers > 1:
+            print(f'Processing the participants with {workers} worker processes.')
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(process, *job): i for i, job in jobs}
+                for future in as_completed(futures):
+                    finished(futures[future], future.result())
+        else:
+            for i, job in jobs:
+                finished(i, process(*job))
+    except BaseException:
+        writer.close(commit=False)
+        table.close(commit=False)
+        raise
+    else:
+        writer.close()
+    finally:
+        checkpoint.close()
 
-    address = Path(fname_outdir) / "results.tsv"
-    cf = pd.read_csv(address, sep='\t', skiprows=4, header=0)
-    cf = cf.drop(['Name of Images'], axis=1)
-    cf = cf.fillna('N/A')
-    cf.to_csv(Path(fname_outdir) / 'IQM.csv', index=False)
+    # IQM.csv comes from the rows already in memory, results.tsv is not parsed back
+    table.write_csv(Path(fname_outdir) / 'IQM.csv')
 
     print(f"The IQMs data are saved in the {Path(fname_outdir) / 'IQM.csv'} file.")
+    if columnar:
+        for path in table.write_columnar():
+            print(f"The {columnar} table is saved in the {path} file.")
+    if settings['timings']:
+        timings = timer.records() + timings
+        write_timings(Path(fname_outdir) / 'timings.jsonl', timings)
+        print(summary_table(timings))
+        print(f"The stage timings are saved in the {Path(fname_outdir) / 'timings.jsonl'} file.")
+    if settings['profile'] is not None:
+        print(f"The profile of {settings['profile']} is saved in the {fname_outdir} directory.")
     print("Done!")
-    print("RadQy backend took", format((time.time() - time.time()) / 60, '.2f'),
+    print("RadQy backend took", format((time.time() - start_time) / 60, '.2f'),
           f"minutes for {total_participants} subjects and the overall {total_scans} {scan_type} scans to run.")
 
     print_folder_path = Path(print_forlder_note)
@@ -600,12 +1094,6 @@ def main(args):
 
 ###############################################################################################
 
-nfiledone = 0
-csv_report = None
-first = True
-headers = []
-
-
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
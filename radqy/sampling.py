@@ -0,0 +1,103 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from .volumetric import Moments
+
+
+# Adaptive slice sampling: `radqy ... --adaptive 0.05`.
+#
+# Instead of every -b-th slice, the candidate slices are visited in
+# stratified order (the middle one, then the middles of the two halves,
+# of the four quarters, ...) a few at a time. After each batch the running
+# mean and variance of every metric give the half width of its confidence
+# interval, z * s / sqrt(n) * sqrt(1 - n / N) with the finite population
+# correction for sampling n of the N candidates without replacement, and
+# sampling stops once that is within the tolerance times the mean for the
+# metrics of DEFAULT_METRICS, or those named with --adaptive-metrics.
+# Metrics that are nearly always zero, like CPP, or ratios over a noise
+# estimate that can come close to zero, like SNR4 and CNR, may never settle
+# to a relative tolerance, so by default only the metrics of intensities
+# and energies are tested; the others are still averaged over the slices
+# used. Metrics whose mean is not finite are left out of the test.
+#
+# The slices needed grow as (z * cv / tolerance) ** 2 with the spread cv of
+# a metric between slices: with the 15-30% of the benchmark phantoms a 5%
+# tolerance needs most of a 40-slice window and 10% stops after 12 slices
+# (test_pkg/benchmark.py reports the slices used).
+
+MIN_SLICES = 8
+STEP = 4
+DEFAULT_METRICS = ('MEAN', 'RNG', 'PSNR', 'EFC', 'FBER')
+
+
+def stratified_order(n):
+    """0 .. n-1 in van der Corput order: n // 2 first, then bisecting outward."""
+    order, seen = [], set()
+    k = 1
+    while len(order) < n:
+        # base-2 radical inverse of k: 1/2, 1/4, 3/4, 1/8, 5/8, ...
+        fraction, scale, i = 0.0, 0.5, k
+        while i:
+            fraction += scale * (i & 1)
+            scale /= 2
+            i >>= 1
+        j = int(fraction * n)
+        if j not in seen:
+            seen.add(j)
+            order.append(j)
+        k += 1
+    return order
+
+
+class AdaptiveSampler:
+    """Hands out batches of candidate slices until the metric means have converged."""
+
+    def __init__(self, candidates, tolerance, confidence=0.95, metrics=None, min_slices=MIN_SLICES, step=STEP):
+        self.order = [candidates[k] for k in stratified_order(len(candidates))]
+        self.tolerance = tolerance
+        self.metrics = metrics or DEFAULT_METRICS
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.min_slices = min_slices
+        self.step = step
+        self.used = 0
+        self.moments = {}
+        self.limiting = None
+
+    def add(self, outputs):
+        """Adds the per-slice values {metric name: values} of the last batch."""
+        for name, values in outputs.items():
+            self.moments.setdefault(name, Moments()).add(np.asarray(values, dtype=np.float64))
+
+    def half_width(self, name):
+        m = self.moments[name]
+        if m.n >= len(self.order):
+            return 0.0
+        return self.z * np.sqrt(m.sample_var / m.n * (1 - m.n / len(self.order)))
+
+    def converged(self):
+        """Whether every tested metric is within the tolerance; limiting is the furthest one."""
+        tested = [name for name in self.moments if name in self.metrics] or list(self.moments)
+        excess = {name: self.half_width(name) - self.tolerance * abs(self.moments[name].mean)
+                  for name in tested if np.isfinite(self.moments[name].mean)}
+        if excess:
+            self.limiting = max(excess, key=excess.get)
+        return all(value <= 0 for value in excess.values())
+
+    def next_batch(self):
+        """The next slices to score, or [] once the means converged or every candidate was used."""
+        if self.used >= len(self.order) or (self.used >= self.min_slices and self.converged()):
+            return []
+        size = self.min_slices if self.used == 0 else self.step
+        batch = self.order[self.used:self.used + size]
+        self.used += len(batch)
+        return batch
+
+    def status(self):
+        # limiting is from the last test, before the final batch
+        if self.used < len(self.order):
+            last = f', {self.limiting} last' if self.limiting else ''
+            return f'the metric means converged after {self.used} of {len(self.order)} slices{last}'
+        if self.limiting:
+            return f'all {self.used} slices were needed, {self.limiting} had not converged'
+        return f'all {self.used} slices were needed'
@@ -0,0 +1,290 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+from .discovery import group_dicom_series, read_dicom_headers, scan_files
+from .radqy import (count_tags, extract_subject_id, load_tag_plan, metric_functions, process_participant,
+                    run_settings)
+
+
+# Watch-folder mode: `radqy serve <output_folder_name> --watch <dir>`.
+#
+# The watched folder is polled with scan_files, which walks the whole tree
+# and stats every image file on each poll (about 80 ms per 10,000 files on
+# a local disk), so scored studies should be moved out of a folder that
+# keeps growing. A unit of arrival is a DICOM series, grouped by
+# group_dicom_series as input_data does whatever folders its files are
+# in, or a single NIfTI/MHA/MAT file; it is considered complete once none
+# of its files has changed size or mtime for the quiescence time. Complete
+# units are queued on a process pool and their rows added to results.tsv
+# of the output folder as they finish (PublishedResults). A unit that
+# changes again after it was processed (late slices of a series) is
+# processed again and its participant's row is replaced; should the older
+# submission finish after the newer one, its row is dropped.
+#
+# serve_log.jsonl gets one record per published participant with the
+# arrival time of its first and last file (their mtimes), when the unit
+# was seen complete, when it was queued and when its row was written, so
+# the latency from arrival to result can be measured. A dropped row is
+# logged with the time it was dropped as 'superseded' instead.
+
+
+def subject_type_of(path):
+    if path.endswith('.dcm'):
+        return 'dicom'
+    if path.endswith('.mha'):
+        return 'mha'
+    if path.endswith('.nii') or path.endswith('.gz'):
+        return 'nifti'
+    if path.endswith('.mat'):
+        return 'mat'
+    return None
+
+
+class FolderWatcher:
+    """Polls a folder and reports units of files that stopped changing.
+
+    A unit is a DICOM series, whatever folders its files are in, or a
+    single NIfTI/MHA/MAT file. The headers of new or changed DICOM files
+    are read as they are seen; a file that cannot be read yet (still being
+    written) is read again on the next poll and holds back the series of
+    its folder until it has not changed for the quiescence time either.
+    """
+
+    def __init__(self, root, quiescence=5.0, io_threads=16):
+        self.root = root
+        self.quiescence = quiescence
+        self.io_threads = io_threads
+        self.stats = {}
+        self.changed = {}
+        self.headers = {}
+        self.removed = {}
+        self.published = {}
+
+    def poll(self, now=None):
+        """Returns {unit: {path: (size, mtime_ns)}} for the units complete since the last call.
+
+        The files of a DICOM series unit are in slice order.
+        """
+        now = time.time() if now is None else now
+        # Every poll walks the watched tree and stats each image file in it
+        # (os.walk + os.stat), so its cost grows with the files kept there.
+        stats = scan_files(self.root)
+        for path, stat in stats.items():
+            if self.stats.get(path) != stat:
+                self.changed[path] = now
+                self.headers.pop(path, None)
+        for path in set(self.stats) - set(stats):
+            self.changed.pop(path, None)
+            self.headers.pop(path, None)
+        # A removed file changes the unit it was in, found from its folder
+        for path in set(self.stats) - set(stats):
+            self.removed[os.path.dirname(path)] = now
+        self.stats = stats
+
+        dicom_files = [path for path in stats if path.endswith('.dcm')]
+        unread = [path for path in dicom_files if path not in self.headers]
+        for path, header in zip(unread, read_dicom_headers(unread, self.io_threads)):
+            if header['error'] is None:
+                self.headers[path] = header
+        readable = [path for path in dicom_files if path in self.headers]
+        units = {('dicom', subject): paths
+                 for subject, paths in group_dicom_series(readable, [self.headers[p] for p in readable]).items()}
+        units.update({('file', path): [path] for path in stats if not path.endswith('.dcm')})
+        # Folders with a DICOM file that is not readable yet, and when it last changed
+        pending = {}
+        for path in dicom_files:
+            if path not in self.headers:
+                folder = os.path.dirname(path)
+                pending[folder] = max(pending.get(folder, 0), self.changed[path])
+
+        ready = {}
+        for unit, paths in units.items():
+            folders = {os.path.dirname(path) for path in paths}
+            last_change = max([self.changed[path] for path in paths] +
+                              [max(pending.get(folder, 0), self.removed.get(folder, 0)) for folder in folders])
+            if now - last_change < self.quiescence:
+                continue
+            fingerprint = frozenset((path, stats[path]) for path in paths)
+            if self.published.get(unit) == fingerprint:
+                continue
+            self.published[unit] = fingerprint
+            ready[unit] = {path: stats[path] for path in paths}
+        return ready
+
+
+def unit_participants(unit, files):
+    """[(subject_id, subject_type, path)] of a complete unit, as input_data would list them."""
+    kind, location = unit
+    if kind == 'dicom':
+        return [(location, 'dicom', list(files))]
+    subject_type = subject_type_of(location)
+    if subject_type is None:
+        return []
+    return [(extract_subject_id(location), subject_type, location)]
+
+
+def read_results(path):
+    """(columns, {participant: {column: value}}) of a results.tsv; ([], {}) if there is none.
+
+    Every header block of the file starts a new column line; the columns
+    are those of all blocks in order of appearance and a participant listed
+    twice keeps its last row.
+    """
+    columns, rows = [], {}
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return columns, rows
+    names = None
+    for line in lines:
+        if line.startswith('#'):
+            names = None
+        elif names is None:
+            names = line.split('\t')
+            columns += [name for name in names if name not in columns]
+        elif line:
+            row = dict(zip(names, line.split('\t')))
+            rows[row.get('Participant', '')] = row
+    return columns, rows
+
+
+class PublishedResults:
+    """results.tsv of the watch-folder mode.
+
+    The row of a new participant whose columns are those of the file is
+    appended. A participant scored again replaces its row, and a row with
+    columns the file does not have (another scan type, other header tags)
+    gives a fresh header with the columns of all rows, empty where a row
+    has no value; either rewrites the file atomically.
+    """
+
+    def __init__(self, path, headers):
+        self.path = path
+        self.headers = headers
+        self.columns, self.rows = read_results(path)
+
+    def write(self, s):
+        row = {field: str(s[field]) for field in s["output"]}
+        added = [field for field in s["output"] if field not in self.columns]
+        replaced = row['Participant'] in self.rows
+        self.rows[row['Participant']] = row
+        if added or replaced:
+            self.columns += added
+            self._rewrite()
+            return
+        with open(self.path, 'a') as f:
+            f.write(self._line(row))
+
+    def _line(self, row):
+        return "\t".join(row.get(column, '') for column in self.columns) + "\n"
+
+    def _rewrite(self):
+        partial = str(self.path) + '.partial'
+        with open(partial, 'w') as f:
+            f.write("\n".join(["#" + h for h in self.headers]) + "\n")
+            f.write("#dataset:" + "\n")
+            f.write("\t".join(self.columns) + "\n")
+            for row in self.rows.values():
+                f.write(self._line(row))
+        os.replace(partial, self.path)
+
+
+def serve(args):
+    watch = args.watch
+    scan_type = args.t
+    workers = getattr(args, 'workers', 1) or 1
+    fname_outdir = Path.cwd() / 'UserInterface' / 'Data' / args.output_folder_name
+    Path(fname_outdir).mkdir(parents=True, exist_ok=True)
+    settings = run_settings(args, fname_outdir)
+    tag_plan = load_tag_plan(scan_type)
+    functions = metric_functions()
+
+    results = Path(fname_outdir) / 'results.tsv'
+    headers = [f"start_time:\t{datetime.datetime.now()}", f"outdir:\t{Path(fname_outdir).resolve()}",
+               f"scantype:\t{scan_type}"]
+    # Rows are added to the results of earlier runs into the same folder
+    writer = PublishedResults(results, headers)
+    log = open(Path(fname_outdir) / 'serve_log.jsonl', 'a', buffering=1)
+    watcher = FolderWatcher(watch, args.quiescence, getattr(args, 'io_threads', 16))
+    print(f'RadQy is watching {watch} for {scan_type} data (poll every {args.poll}s, '
+          f'complete after {args.quiescence}s without changes). Press Ctrl+C to stop.')
+
+    pending = {}
+    published = 0
+    # The latest submission of every participant; a unit that changed again
+    # while it was being scored is queued again, and the row of the older
+    # submission must not replace that of the newer one if it ends last.
+    generations = {}
+    last_activity = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                now = time.time()
+                for unit, files in watcher.poll(now).items():
+                    mtimes = [mtime / 1e9 for _, mtime in files.values()]
+                    for subject, subject_type, path in unit_participants(unit, files):
+                        try:
+                            total_tags = count_tags(tag_plan, subject_type, path)
+                        except Exception as e:
+                            print(f'Skipping {subject}: {e}')
+                            continue
+                        published += 1
+                        generations[subject] = generations.get(subject, 0) + 1
+                        future = pool.submit(process_participant, published, published, subject, path,
+                                             subject_type, tag_plan, total_tags, functions, settings)
+                        pending[future] = {'participant': subject, 'files': len(files),
+                                           'first_arrival': min(mtimes), 'last_arrival': max(mtimes),
+                                           'complete': now, 'queued': time.time(),
+                                           'generation': generations[subject]}
+                    last_activity = now
+                if pending:
+                    done, _ = wait(pending, timeout=args.poll, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record = pending.pop(future)
+                        if record['generation'] < generations[record['participant']]:
+                            record['superseded'] = time.time()
+                            log.write(json.dumps(record) + '\n')
+                            print(f"{record['participant']}: dropped the result of files that have changed since.")
+                            continue
+                        try:
+                            s = future.result()
+                        except Exception as e:
+                            record['error'] = f'{type(e).__name__}: {e}'
+                        else:
+                            s.pop("timings", None)
+                            writer.write(s)
+                        record['published'] = time.time()
+                        record['latency_s'] = record['published'] - record['last_arrival']
+                        log.write(json.dumps(record) + '\n')
+                        print(f"{record['participant']}: published {record['latency_s']:.2f}s after its last file arrived.")
+                        last_activity = time.time()
+                else:
+                    time.sleep(args.poll)
+                if args.idle_exit is not None and not pending and time.time() - last_activity > args.idle_exit:
+                    print(f'No new data for {args.idle_exit}s, stopping.')
+                    break
+    except KeyboardInterrupt:
+        print('Stopping.')
+    finally:
+        log.close()
+    print(f"{published} participants were queued; the results are in {results}.")
+    summary = latency_summary(Path(fname_outdir) / 'serve_log.jsonl')
+    if summary['count']:
+        print(f"Arrival to result over {summary['count']} participants: mean {summary['mean_s']:.2f}s, "
+              f"median {summary['median_s']:.2f}s, max {summary['max_s']:.2f}s.")
+
+
+def latency_summary(log_path):
+    """Count, mean, median and max of the arrival-to-result latency in a serve_log.jsonl."""
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    latencies = sorted(record['latency_s'] for record in records if 'latency_s' in record)
+    if not latencies:
+        return {'count': 0}
+    return {'count': len(latencies), 'mean_s': sum(latencies) / len(latencies),
+            'median_s': latencies[len(latencies) // 2], 'max_s': latencies[-1]}
@@ -0,0 +1,157 @@
+import gzip
+import os
+import struct
+import numpy as np
+
+from .volumes import LazyVolume
+
+
+# Header-first readers for single-file NIfTI-1 (.nii, .nii.gz) and MetaImage
+# (.mha, .mhd) volumes. Only the header is parsed up front; voxel data of
+# uncompressed files is memory-mapped and gzip files are inflated slice by
+# slice, so a window of slices never needs the whole image in memory. Files
+# these readers do not handle (other dimensions, vector pixels, compressed
+# MetaImage, NIfTI pairs) return None and are read with SimpleITK instead.
+
+NIFTI_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8',
+                256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+MET_DTYPES = {'MET_UCHAR': 'u1', 'MET_CHAR': 'i1', 'MET_USHORT': 'u2', 'MET_SHORT': 'i2',
+              'MET_UINT': 'u4', 'MET_INT': 'i4', 'MET_ULONG_LONG': 'u8', 'MET_LONG_LONG': 'i8',
+              'MET_FLOAT': 'f4', 'MET_DOUBLE': 'f8'}
+
+
+def read_nifti_header(path, timeseries=False):
+    """Shape (z, y, x), dtype and data location of a 3D NIfTI-1 file, from its 348-byte header.
+
+    With timeseries, 4D files are accepted too; 'timepoints' is the length
+    of their fourth axis (1 for 3D files).
+    """
+    compressed = str(path).endswith('.gz')
+    with (gzip.open if compressed else open)(path, 'rb') as f:
+        hdr = f.read(348)
+    if len(hdr) < 348 or hdr[344:348] != b'n+1\x00':
+        return None
+    endian = '<' if struct.unpack('<i', hdr[:4])[0] == 348 else '>'
+    dim = struct.unpack(endian + '8h', hdr[40:56])
+    datatype = struct.unpack(endian + 'h', hdr[70:72])[0]
+    vox_offset = struct.unpack(endian + 'f', hdr[108:112])[0]
+    slope, intercept = struct.unpack(endian + '2f', hdr[112:120])
+    timepoints = max(dim[4], 1) if dim[0] >= 4 and timeseries else 1
+    if not 3 <= dim[0] <= 7 or any(d != 1 for d in dim[5 if timeseries else 4:dim[0] + 1]) or datatype not in NIFTI_DTYPES:
+        return None
+    if not np.isfinite(slope) or slope == 0 or (slope == 1 and intercept == 0):
+        slope, intercept = None, None
+    return {'shape': (dim[3], dim[2], dim[1]), 'dtype': np.dtype(endian + NIFTI_DTYPES[datatype]),
+            'data_file': str(path), 'offset': int(vox_offset), 'compressed': compressed,
+            'slope': slope, 'intercept': intercept, 'timepoints': timepoints}
+
+
+def read_metaimage_header(path, timeseries=False):
+    """Shape (z, y, x), dtype and data location of an uncompressed 3D (or, with timeseries, 4D) MetaImage file."""
+    fields = {}
+    with open(path, 'rb') as f:
+        while 'ElementDataFile' not in fields:
+            line = f.readline()
+            key, sep, value = line.decode('latin-1').partition('=')
+            if not sep:
+                return None
+            fields[key.strip()] = value.strip()
+        offset = f.tell()
+    dim_size = fields.get('DimSize', '').split()
+    n_dims = ('3', '4') if timeseries else ('3',)
+    if (fields.get('NDims') not in n_dims or len(dim_size) != int(fields['NDims']) or fields.get('ElementType') not in MET_DTYPES
+            or fields.get('CompressedData', 'False').lower() == 'true'
+            or fields.get('ElementNumberOfChannels', '1') != '1'
+            or fields.get('BinaryData', 'True').lower() != 'true'):
+        return None
+    msb = fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False'))
+    dtype = np.dtype(('>' if msb.lower() == 'true' else '<') + MET_DTYPES[fields['ElementType']])
+    shape = tuple(int(d) for d in reversed(dim_size))
+    timepoints = shape[0] if len(shape) == 4 else 1
+    shape = shape[-3:]
+    data_file = fields['ElementDataFile']
+    if data_file != 'LOCAL':
+        if data_file.startswith('LIST') or '%' in data_file:
+            return None
+        data_file = os.path.join(os.path.dirname(str(path)), data_file)
+        offset = int(fields.get('HeaderSize', 0))
+    else:
+        data_file = str(path)
+    if offset < 0:
+        # HeaderSize = -1: the data is at the end of the file
+        offset = os.path.getsize(data_file) - timepoints * int(np.prod(shape)) * dtype.itemsize
+    return {'shape': shape, 'dtype': dtype, 'data_file': data_file, 'offset': offset,
+            'compressed': False, 'slope': None, 'intercept': None, 'timepoints': timepoints}
+
+
+def read_header(path, timeseries=False):
+    """read_nifti_header or read_metaimage_header by file extension; None for other files."""
+    path = str(path)
+    if path.endswith('.nii') or path.endswith('.nii.gz'):
+        return read_nifti_header(path, timeseries)
+    if path.endswith('.mha') or path.endswith('.mhd'):
+        return read_metaimage_header(path, timeseries)
+    return None
+
+
+def _native(header, image):
+    # Native byte order, and scl_slope/scl_inter applied in float32 as
+    # SimpleITK does for scaled NIfTI images.
+    if header['slope'] is not None:
+        return (image.astype(np.float64) * header['slope'] + header['intercept']).astype(np.float32)
+    if not image.dtype.isnative:
+        return image.astype(image.dtype.newbyteorder('='))
+    return image
+
+
+def stream_volume(path, start, stop):
+    """Slices start:stop of a NIfTI-1 or MetaImage file, without reading the rest.
+
+    Uncompressed files give a view of a memory map (or, when the voxels need
+    scaling or byte swapping, a LazyVolume converting each slice on access);
+    .nii.gz files give a LazyVolume that inflates forward to each slice it
+    is asked for, or the whole window once slices are asked for out of
+    order; its gzip stream is closed once the window is inflated or by
+    LazyVolume.close. Returns None when the file needs SimpleITK.
+    """
+    header = read_header(path)
+    if header is None:
+        return None
+    shape, dtype = header['shape'], header['dtype']
+    if not header['compressed']:
+        try:
+            data = np.memmap(header['data_file'], dtype=dtype, mode='r', offset=header['offset'], shape=shape)
+        except (OSError, ValueError):
+            return None
+        window = data[start:stop]
+        if header['slope'] is None and dtype.isnative:
+            return window
+        return LazyVolume(len(window), lambda k: _native(header, window[k]), shape[1:])
+
+    slice_bytes = shape[1] * shape[2] * dtype.itemsize
+    stream = gzip.open(header['data_file'], 'rb')
+    n_slices = len(range(shape[0])[start:stop])
+    window = []
+
+    def read_slice(k):
+        # Forward seeks inflate and discard. A backward seek would inflate
+        # the file from the start again, and --adaptive visits the slices
+        # bisecting outward, so the first one inflates the whole window
+        # once and later slices are taken from it.
+        position = header['offset'] + (start + k) * slice_bytes
+        if not window and stream.tell() > position:
+            stream.seek(header['offset'] + start * slice_bytes)
+            buffer = stream.read(n_slices * slice_bytes)
+            if len(buffer) < n_slices * slice_bytes:
+                raise ValueError(f"{path} ends before slice {start + n_slices - 1}")
+            window.append(np.frombuffer(buffer, dtype=dtype).reshape((n_slices,) + shape[1:]))
+            stream.close()
+        if window:
+            return _native(header, window[0][k])
+        stream.seek(position)
+        buffer = stream.read(slice_bytes)
+        if len(buffer) < slice_bytes:
+            raise ValueError(f"{path} ends before slice {start + k}")
+        return _native(header, np.frombuffer(buffer, dtype=dtype).reshape(shape[1:]))
+    return LazyVolume(n_slices, read_slice, shape[1:], on_close=stream.close)
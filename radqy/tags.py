@@ -0,0 +1,92 @@
+import numpy as np
+
+
+non_tag_value = 'NA'
+
+
+def clean_value(number):
+    if isinstance(number, (int, float)):
+        number = '{:.2f}'.format(number)
+        if number.replace(".", "", 1).isdigit():
+            number = float(number)
+            if number % 1 == 0:
+                number = int(number)
+            else:
+                number = round(number, 2)
+    number = np.array(number)
+    return number
+
+
+def _plain(value):
+    # numpy scalars and 0-d arrays as the Python values they hold
+    if isinstance(value, np.generic) or (isinstance(value, np.ndarray) and value.ndim == 0):
+        return value.item()
+    return value
+
+
+def _sitk_geometry(image, keyword):
+    # Header fields SimpleITK images answer from their geometry.
+    if keyword == "Rows":
+        return image.GetSize()[1]
+    if keyword == "Columns":
+        return image.GetSize()[0]
+    if keyword == "PixelSpacing":
+        return list(image.GetSpacing())
+    if keyword == "SliceThickness":
+        return image.GetSpacing()[2]
+    return non_tag_value
+
+
+class TagPlan:
+    """The tags of MRI_TAGS.yaml or CT_TAGS.yaml, compiled once per run.
+
+    Each entry is (keyword, DICOM tag number, abbreviations): the YAML key
+    without spaces, its tag in the DICOM dictionary (None if it is not a
+    DICOM keyword) and the column names its value is split into. extract()
+    runs the plan against a pydicom dataset or a SimpleITK image or
+    ImageFileReader and returns a plain {abbreviation: value} record.
+    """
+
+    def __init__(self, tag_data):
+        from pydicom.datadict import tag_for_keyword
+        self.entries = []
+        for name, abbreviations in tag_data.items():
+            keyword = name.replace(" ", "")
+            if isinstance(abbreviations, list):
+                abbreviations = ','.join(abbreviations)
+            self.entries.append((keyword, tag_for_keyword(keyword), abbreviations.split(',')))
+
+    @property
+    def dicom_tags(self):
+        """Tag numbers to read with pydicom's specific_tags."""
+        return [tag for _, tag, _ in self.entries if tag is not None]
+
+    @property
+    def n_tags(self):
+        return sum(len(abbreviations) for _, _, abbreviations in self.entries)
+
+    def lookup(self, image, file_type, keyword, tag):
+        if file_type == 'dicom':
+            if tag is None or tag not in image:
+                return non_tag_value
+            return image[tag].value
+        if file_type in ['mha', 'nifti']:
+            if image.HasMetaDataKey(keyword):
+                return image.GetMetaData(keyword)
+            return _sitk_geometry(image, keyword)
+        return non_tag_value  # Add MAT specific metadata extraction here if needed
+
+    def extract(self, image, file_type='dicom'):
+        record = {}
+        for keyword, tag, abbreviations in self.entries:
+            tag_value = self.lookup(image, file_type, keyword, tag)
+            if isinstance(tag_value, str) and tag_value == non_tag_value:
+                continue
+            tag_value = clean_value(tag_value)
+            for j, abbreviation in enumerate(abbreviations):
+                if np.iterable(tag_value):
+                    tag_value_j = tag_value[j] if j < len(tag_value) else non_tag_value
+                else:
+                    tag_value_j = tag_value
+                record[abbreviation] = _plain(tag_value_j)
+        return record
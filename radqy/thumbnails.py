@@ -0,0 +1,197 @@
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+
+# Thumbnails of the sampled slices and their masks.
+#
+# The grey levels are those plt.imsave(..., cmap=cm.Greys_r) produced: the
+# slice is scaled to [0, 1] between its minimum and maximum (in float32 for
+# 8/16-bit data, as matplotlib's Normalize does), split into the 256 entries
+# of the colormap and looked up. The PNG is written directly as 8-bit
+# greyscale instead of RGBA through matplotlib and Pillow.
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Largest side of one sprite sheet; browsers refuse larger canvases.
+SPRITE_MAX_SIDE = 8192
+
+
+@lru_cache(maxsize=None)
+def greys_lut():
+    """The 256 grey levels of matplotlib's Greys_r colormap, as imsave writes them."""
+    from matplotlib import colormaps
+    return colormaps['Greys_r'](np.arange(256), bytes=True)[:, 0]
+
+
+def to_gray(image):
+    """Min-max window of a 2D slice mapped to 8-bit grey levels."""
+    x = np.asarray(image)
+    x = x.astype(np.promote_types(x.dtype, np.float32))
+    if x.size == 0:
+        return np.zeros(x.shape, dtype=np.uint8)
+    vmin, vmax = np.nanmin(x), np.nanmax(x)
+    if not vmax > vmin:
+        return np.full(x.shape, greys_lut()[0])
+    x -= vmin
+    x /= (vmax - vmin)
+    x *= 256
+    index = np.nan_to_num(x, nan=0).astype(np.intp)
+    np.minimum(index, 255, out=index)
+    return greys_lut()[index]
+
+
+def downscale(gray, max_size):
+    """Block-average a grey image so that neither side exceeds max_size pixels."""
+    factor = -(-max(gray.shape) // max_size)
+    if factor <= 1:
+        return gray
+    h, w = gray.shape
+    padded = np.pad(gray, ((0, -h % factor), (0, -w % factor)), mode='edge')
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return np.rint(blocks.mean(axis=(1, 3))).astype(np.uint8)
+
+
+def _chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+def encode_png(gray, level=6):
+    """8-bit greyscale PNG bytes, every row but the first with the Up filter."""
+    h, w = gray.shape
+    rows = np.empty((h, w + 1), dtype=np.uint8)
+    rows[:, 0] = 2
+    rows[0, 0] = 0
+    rows[0, 1:] = gray[0]
+    np.subtract(gray[1:], gray[:-1], out=rows[1:, 1:])
+    header = struct.pack('>IIBBBBB', w, h, 8, 0, 0, 0, 0)
+    return (PNG_SIGNATURE + _chunk(b'IHDR', header) +
+            _chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + _chunk(b'IEND', b''))
+
+
+def _thumbnail(image, max_size):
+    gray = to_gray(image)
+    return downscale(gray, max_size) if max_size else gray
+
+
+def write_thumbnail(path, image, max_size=None):
+    Path(path).write_bytes(encode_png(_thumbnail(image, max_size)))
+
+
+def write_sprite(folder, names, grays):
+    """Tiles grey thumbnails into sprite_<k>.png sheets in folder and describes them in sprite.json.
+
+    The manifest lists every tile in the given order with its name, sheet
+    and pixel offset, so a viewer can crop it out of the sheet.
+    """
+    folder = Path(folder)
+    tile_h = max(g.shape[0] for g in grays)
+    tile_w = max(g.shape[1] for g in grays)
+    columns = max(1, min(math.ceil(math.sqrt(len(grays))), SPRITE_MAX_SIDE // tile_w))
+    per_sheet = columns * max(1, SPRITE_MAX_SIDE // tile_h)
+    manifest = {'tile_width': tile_w, 'tile_height': tile_h, 'columns': columns, 'sheets': [], 'tiles': []}
+    for first in range(0, len(grays), per_sheet):
+        sheet_grays = grays[first:first + per_sheet]
+        rows = math.ceil(len(sheet_grays) / columns)
+        sheet = np.full((rows * tile_h, columns * tile_w), greys_lut()[0], dtype=np.uint8)
+        sheet_name = f"sprite_{len(manifest['sheets'])}.png"
+        for k, gray in enumerate(sheet_grays):
+            y, x = (k // columns) * tile_h, (k % columns) * tile_w
+            sheet[y:y + gray.shape[0], x:x + gray.shape[1]] = gray
+            manifest['tiles'].append({'name': names[first + k], 'sheet': len(manifest['sheets']),
+                                      'x': x, 'y': y, 'width': gray.shape[1], 'height': gray.shape[0]})
+        (folder / sheet_name).write_bytes(encode_png(sheet))
+        manifest['sheets'].append(sheet_name)
+    (folder / 'sprite.json').write_text(json.dumps(manifest, indent=1))
+
+
+class ThumbnailWriter:
+    """Writes thumbnails on a bounded thread pool while the caller carries on.
+
+    With layout='files' every image is its own PNG. With layout='sprite' the
+    images are windowed in the pool and, on close, the images of each folder
+    are tiled into sprite sheets with a sprite.json manifest (write_sprite)
+    in place of the individual files.
+
+    At most max_pending images wait to be processed; submit blocks beyond
+    that. close (or leaving the with block) waits for every write and
+    raises the first error; leaving the with block on an exception cancels
+    the writes not yet started instead. With threads=0 the work is done in
+    submit.
+    busy adds up the seconds spent encoding and writing, over all threads.
+    """
+
+    def __init__(self, max_size=None, threads=4, max_pending=32, layout='files'):
+        self.max_size = max_size
+        self.layout = layout
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.sheets = {}
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.busy += time.perf_counter() - start
+
+    def _run(self, func, *args):
+        args = (func,) + args
+        func = self._timed
+        if self.pool is None:
+            future = Future()
+            future.set_result(func(*args))
+            return future
+        self.slots.acquire()
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def submit(self, path, image):
+        path = Path(path)
+        if self.layout == 'sprite':
+            self.sheets.setdefault(path.parent, []).append((path.name, self._run(_thumbnail, image, self.max_size)))
+        else:
+            self.futures.append(self._run(write_thumbnail, path, image, self.max_size))
+
+    def close(self):
+        sheets, self.sheets = self.sheets, {}
+        for folder, tiles in sheets.items():
+            names = [name for name, _ in tiles]
+            grays = [future.result() for _, future in tiles]
+            self.futures.append(self._run(write_sprite, folder, names, grays))
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def abort(self):
+        """Cancels the writes not yet started and waits for the others, without raising their errors."""
+        futures = self.futures + [future for tiles in self.sheets.values() for _, future in tiles]
+        self.futures, self.sheets = [], {}
+        for future in futures:
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,248 @@
+import gzip
+import warnings
+from contextlib import nullcontext
+from pathlib import Path
+
+import numpy as np
+
+from .profiling import StageTimer, profiled
+from .radqy import IQM, middle_slices, sampled_masks, sampled_metrics, shift_to_zero
+from .streaming import _native, read_header
+from .thumbnails import ThumbnailWriter
+
+
+# 4D (fMRI, DWI, DCE) series: `radqy <output> <input> --timeseries`.
+#
+# The timepoints of a 4D NIfTI or MetaImage file are read one at a time
+# (memory-mapped, inflated in order for .nii.gz, or as SimpleITK extract
+# regions) and only the sampled slices of the middle window are kept, so
+# the whole 4D array is never in memory. Each timepoint feeds
+#
+# - TemporalStats: running (Welford) voxel mean and variance for the tSNR
+#   map, the mean signal of every timepoint for the drift and the RMS
+#   difference to the previous timepoint (DVARS), in a single pass;
+# - the spatial IQMs, computed by the batched metric code on the slices of
+#   time_batch timepoints at once.
+#
+# The row of a series holds the tags, NT (number of timepoints), the
+# spatial IQMs averaged over slices and time, TSNR (median tSNR in the
+# foreground of the first timepoint), DRIFT (linear signal change over the
+# series, percent of the mean signal) and DVARS (mean frame difference,
+# percent of the mean signal). <participant>/timeseries.tsv has the values
+# of every timepoint and <participant>/tsnr.npy the tSNR map of the sampled
+# slices, whose thumbnails are the images of the row.
+
+
+class TemporalStats:
+    """One-pass temporal statistics of a (n_slices, H, W) stack seen once per timepoint."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self.previous = None
+        self.signal = []
+        self.dvars = []
+
+    def add(self, frame, mask):
+        x = frame.astype(np.float64)
+        if self.mean is None:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros_like(x)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        inside = mask if mask.any() else np.ones_like(mask)
+        self.signal.append(float(x[inside].mean()))
+        if self.previous is None:
+            self.dvars.append(np.nan)
+        else:
+            self.dvars.append(float(np.sqrt(np.mean((x - self.previous)[inside] ** 2))))
+        self.previous = x
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.m2 / (self.n - 1))
+
+    def tsnr(self):
+        std = self.std
+        return np.divide(self.mean, std, out=np.zeros_like(self.mean), where=std > 0)
+
+    def drift(self):
+        """Linear change of the mean signal from the first to the last timepoint, in percent of its mean."""
+        if self.n < 2:
+            return 0.0
+        signal = np.asarray(self.signal)
+        slope = np.polyfit(np.arange(self.n), signal, 1)[0]
+        return float(100 * slope * (self.n - 1) / signal.mean()) if signal.mean() else 0.0
+
+    def mean_dvars(self):
+        """Mean frame difference, in percent of the mean signal."""
+        if self.n < 2:
+            return 0.0
+        signal = np.mean(self.signal)
+        return float(100 * np.nanmean(self.dvars) / signal) if signal else 0.0
+
+
+def timepoints(path, slice_indices):
+    """Yields the slices slice_indices of every timepoint of a 3D or 4D NIfTI/MetaImage file."""
+    header = read_header(path, timeseries=True)
+    if header is not None and not header['compressed']:
+        shape = (header['timepoints'],) + header['shape']
+        data = np.memmap(header['data_file'], dtype=header['dtype'], mode='r', offset=header['offset'], shape=shape)
+        for t in range(shape[0]):
+            yield _native(header, np.array(data[t, slice_indices]))
+        return
+    if header is not None:
+        z, y, x = header['shape']
+        slice_bytes = y * x * header['dtype'].itemsize
+        with gzip.open(header['data_file'], 'rb') as stream:
+            for t in range(header['timepoints']):
+                frame = []
+                for k in slice_indices:
+                    # forward seeks only: timepoints and slices are visited in order
+                    stream.seek(header['offset'] + (t * z + k) * slice_bytes)
+                    buffer = stream.read(slice_bytes)
+                    if len(buffer) < slice_bytes:
+                        raise ValueError(f"{path} ends in timepoint {t}")
+                    frame.append(np.frombuffer(buffer, dtype=header['dtype']).reshape(y, x))
+                yield _native(header, np.stack(frame))
+        return
+    # Other layouts: one SimpleITK extract region per timepoint
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    if len(size) == 3:
+        yield sitk.GetArrayFromImage(reader.Execute())[slice_indices]
+        return
+    for t in range(size[3]):
+        reader.SetExtractIndex([0, 0, 0, t])
+        reader.SetExtractSize([size[0], size[1], size[2], 0])
+        yield sitk.GetArrayFromImage(reader.Execute())[slice_indices]
+
+
+def series_shape(path):
+    """(timepoints, slices) of a 3D or 4D NIfTI/MetaImage file, from its header."""
+    header = read_header(path, timeseries=True)
+    if header is not None:
+        return header['timepoints'], header['shape'][0]
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    size = reader.GetSize()
+    return (size[3] if len(size) > 3 else 1), size[2]
+
+
+class TimeSeriesIQM(IQM):
+    """The row of one 4D series; see the module comment."""
+
+    def __init__(self, path, tags, participant, total_participants, participant_index, total_tags, metric_functions, settings, timer=None):
+        print(f'-------------- Series {participant_index} out of {total_participants}: {participant} --------------')
+        dict.__init__(self)
+        timer = timer or StageTimer(enabled=False)
+        self["warnings"] = []
+        self["output"] = []
+        fname_outdir = Path(settings['fname_outdir'])
+        directory_path = fname_outdir / participant
+        directory_path.mkdir(parents=True, exist_ok=True)
+        time_batch = settings.get('time_batch', 8)
+        total_metrics = total_tags + len(metric_functions) + 6
+
+        _, n_slices = series_shape(path)
+        window = middle_slices(n_slices, settings['middle_size'])
+        slice_indices = list(window[::settings['sample_size']])
+        stats = TemporalStats()
+        temporal_mask = None
+        per_time = {}
+        pending = []
+
+        def score(frames):
+            stack = np.concatenate(frames)
+            masks, irregular = [], {}
+            with timer.stage('foreground'):
+                # each timepoint is a volume of its own for --mask-mode volume,
+                # whatever the number of timepoints scored together
+                for t, frame in enumerate(frames):
+                    frame_masks, frame_irregular = sampled_masks(frame, settings.get('mask_mode', 'slice'),
+                                                                 settings.get('mask_tolerance', 0.02))
+                    masks.append(frame_masks)
+                    irregular.update({t * len(frame) + k: parts for k, parts in frame_irregular.items()})
+            masks = np.concatenate(masks)
+            outputs = sampled_metrics(stack, masks, irregular, metric_functions, settings.get('precision', 'float64'), timer)
+            for name, values in outputs.items():
+                per_time.setdefault(name, []).extend(np.asarray(values).reshape(len(frames), -1).mean(axis=1))
+            return masks[:len(slice_indices)]
+
+        for frame in timepoints(path, slice_indices):
+            if settings['scan_type'] == 'CT':
+                frame = shift_to_zero(frame)
+            pending.append(frame)
+            if temporal_mask is None:
+                # the foreground of the first timepoint is that of the series
+                temporal_mask = score(pending)
+                pending = []
+            with timer.stage('temporal'):
+                stats.add(frame, temporal_mask)
+            if len(pending) >= time_batch:
+                score(pending)
+                pending = []
+        if pending:
+            score(pending)
+
+        tsnr = stats.tsnr().astype(np.float32)
+        np.save(directory_path / 'tsnr.npy', tsnr)
+        with timer.stage('thumbnails'):
+            with ThumbnailWriter(settings.get('thumb_size'), layout=settings.get('thumb_layout', 'files')) as thumbnails:
+                image_names = [self.save_image(participant, tsnr[k], j, fname_outdir, thumbnails)
+                               for k, j in enumerate(slice_indices)]
+
+        columns = ['t', 'signal', 'dvars'] + list(per_time)
+        with open(directory_path / 'timeseries.tsv', 'w') as f:
+            f.write("\t".join(columns) + "\n")
+            for t in range(stats.n):
+                values = [t, stats.signal[t], stats.dvars[t]] + [per_time[name][t] for name in per_time]
+                f.write("\t".join(str(v) for v in values) + "\n")
+
+        self["participant_scan_number"] = len(slice_indices)
+        self["slice_metrics"] = {"Slice": slice_indices, "TSNR": tsnr.reshape(len(slice_indices), -1).mean(axis=1)}
+        self.addToPrintList(0, participant, "Participant", participant, total_metrics)
+        count = 1
+        for metric, value in tags.items():
+            self.addToPrintList(count, participant, metric, value, total_metrics)
+            count += 1
+        self.addToPrintList(1, participant, "Name of Images", image_names, total_metrics)
+        self.addToPrintList(count, participant, "NUM", len(slice_indices), total_metrics)
+        count += 1
+        self.addToPrintList(count, participant, "NT", stats.n, total_metrics)
+        for name, values in per_time.items():
+            count += 1
+            self.addToPrintList(count, participant, name, np.mean(values), total_metrics)
+        inside = temporal_mask if temporal_mask.any() else np.ones_like(temporal_mask)
+        for name, value in (("TSNR", float(np.median(tsnr[inside]))), ("DRIFT", stats.drift()),
+                            ("DVARS", stats.mean_dvars())):
+            count += 1
+            self.addToPrintList(count, participant, name, value, total_metrics)
+
+
+def process_timeseries(participant_index, total_participants, name, path, subject_type, tag_plan, total_tags, functions, settings):
+    """process_participant for a 4D series."""
+    import SimpleITK as sitk
+    warnings.filterwarnings("ignore")
+    timer = StageTimer(name, enabled=settings.get('timings', False))
+    profile = settings.get('profile') == name
+    with profiled(Path(settings['fname_outdir']) / f"profile_{name}", settings.get('profiler', 'cprofile')) if profile else nullcontext():
+        with timer.stage('participant'):
+            with timer.stage('header_read'):
+                reader = sitk.ImageFileReader()
+                reader.SetFileName(str(path))
+                reader.ReadImageInformation()
+                tags = tag_plan.extract(reader, file_type=subject_type)
+            s = TimeSeriesIQM(path, tags, name, total_participants, participant_index, total_tags, functions, settings, timer)
+    s["timings"] = timer.records()
+    return s
\ No newline at end of file
@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class LazyVolume:
+    """A (n_slices, H, W) volume whose slices are decoded when first indexed.
+
+    IQM only visits every sample_size-th slice of the middle window, so the
+    other slices are never read. Decoded slices are kept, indexing the same
+    slice twice decodes it once. slice_shape is the shape read_slice
+    returns, taken from the header of the file; on_close releases what
+    read_slice keeps open (a file stream).
+    """
+
+    def __init__(self, n_slices, read_slice, slice_shape, on_close=None):
+        self.n_slices = n_slices
+        self.read_slice = read_slice
+        self.slice_shape = tuple(slice_shape)
+        self.on_close = on_close
+        self.cache = {}
+
+    def __len__(self):
+        return self.n_slices
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.stack([self[k] for k in range(*index.indices(self.n_slices))])
+        index = int(index)
+        if index < 0:
+            index += self.n_slices
+        if not 0 <= index < self.n_slices:
+            raise IndexError(f"slice {index} out of range for a volume of {self.n_slices} slices")
+        if index not in self.cache:
+            self.cache[index] = self.read_slice(index)
+        return self.cache[index]
+
+    def release(self, stop):
+        """Forgets the decoded slices before stop, which will not be visited again."""
+        for index in [k for k in self.cache if k < stop]:
+            del self.cache[index]
+
+    def close(self):
+        """Forgets the decoded slices and closes the file behind them."""
+        self.cache = {}
+        if self.on_close is not None:
+            self.on_close()
+
+    @property
+    def shape(self):
+        return (self.n_slices,) + self.slice_shape
+
+
+def rescale(pixels, slope, intercept):
+    """pixels * slope + intercept in the narrowest dtype that holds the result.
+
+    Integer slope and intercept keep integer pixels integer; anything else
+    gives float32.
+    """
+    slope = float(slope)
+    intercept = float(intercept)
+    if slope == 1 and intercept == 0:
+        return pixels
+    if pixels.dtype.kind in 'iu' and slope.is_integer() and intercept.is_integer() and pixels.size:
+        lo, hi = int(pixels.min()), int(pixels.max())
+        ends = (lo, hi, lo * int(slope) + int(intercept), hi * int(slope) + int(intercept))
+        for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+            info = np.iinfo(dtype)
+            if info.min <= min(ends) and max(ends) <= info.max:
+                return pixels.astype(dtype) * dtype(slope) + dtype(intercept)
+    return pixels.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+
+
+def dicom_volume(scans, apply_rescale=False):
+    """Lazy volume over DICOM files that are already in slice order.
+
+    Slices keep their stored dtype. With apply_rescale the RescaleSlope and
+    RescaleIntercept of each file are applied as its slice is decoded.
+    """
+    import pydicom
+
+    # the shape pixel_array will have, from the header of the first file
+    shape = ()
+    if scans:
+        ds = pydicom.dcmread(scans[0], stop_before_pixels=True,
+                             specific_tags=['Rows', 'Columns', 'SamplesPerPixel', 'NumberOfFrames'])
+        frames, samples = int(ds.get('NumberOfFrames') or 1), int(ds.get('SamplesPerPixel') or 1)
+        shape = (((frames,) if frames > 1 else ()) + (int(ds.Rows), int(ds.Columns))
+                 + ((samples,) if samples > 1 else ()))
+
+    def read_slice(k):
+        ds = pydicom.dcmread(scans[k])
+        pixels = ds.pixel_array
+        if apply_rescale:
+            pixels = rescale(pixels, ds.get('RescaleSlope', 1), ds.get('RescaleIntercept', 0))
+        return pixels
+    return LazyVolume(len(scans), read_slice, shape)
+
+
+def _compressed(path):
+    # gzip and compressed MetaImage data cannot be read a slice at a time;
+    # ITK would inflate the file from the start for every slice.
+    path = str(path)
+    if path.endswith('.gz'):
+        return True
+    if path.endswith('.mha') or path.endswith('.mhd'):
+        with open(path, 'rb') as f:
+            for line in f:
+                key, _, value = line.partition(b'=')
+                if key.strip() == b'CompressedData':
+                    return value.strip().lower() == b'true'
+                if key.strip() == b'ElementDataFile':
+                    break
+    return False
+
+
+def sitk_volume(reader, slice_indices):
+    """Lazy volume over the given z indices of the image behind a SimpleITK ImageFileReader.
+
+    reader must have read the image information. Each slice of an
+    uncompressed file is read as an extract region of one z plane, without
+    loading the rest of the image; compressed files are read whole, once,
+    when the first slice is needed.
+    """
+    import SimpleITK as sitk
+    size = reader.GetSize()
+    # the array of a slice is the image array without its first axis
+    components = reader.GetNumberOfComponents()
+    shape = tuple(reversed(size))[1:] + ((components,) if components > 1 else ())
+    if len(size) != 3 or _compressed(reader.GetFileName()):
+        image_array = None
+
+        def read_slice(k):
+            nonlocal image_array
+            if image_array is None:
+                image_array = sitk.GetArrayFromImage(reader.Execute())
+            return image_array[slice_indices[k], :, :]
+        return LazyVolume(len(slice_indices), read_slice, shape)
+
+    def read_slice(k):
+        reader.SetExtractIndex([0, 0, slice_indices[k]])
+        reader.SetExtractSize([size[0], size[1], 0])
+        return sitk.GetArrayFromImage(reader.Execute())
+    return LazyVolume(len(slice_indices), read_slice, shape)
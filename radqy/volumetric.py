@@ -0,0 +1,288 @@
+import numpy as np
+from scipy import ndimage as ndi
+
+
+# Volume counterparts of the per-slice metric functions in radqy.py, for
+# --metric-scope volume.
+#
+# Instead of one value per slice averaged over the slices, every metric is
+# computed once over the voxels of the middle window and their foreground
+# masks: the statistics of f and b run over all foreground and background
+# voxels, CPP uses a 3x3x3 Laplacian, PSNR a 3x3x3 median filter (a 5x5x5
+# one takes longer than all other metrics together), SNR5 the variance in
+# 5x5x5 windows, EFC the energy of all voxels and the patches are the
+# 5x5x5 cubes centred on the brightest voxel of F and of B. Metrics
+# without a volume form (SNR9, added funcN) keep their per-slice values.
+#
+# The volume is read in chunks of slices (batch.chunks) with HALO slices
+# of context on either side. VolumeStats.add takes a chunk and the range
+# of its own slices, and keeps running sums, counts, means and M2 (merged
+# as in Chan et al.) so the volume is visited in a single pass; the
+# metric functions below turn them into values.
+
+HALO = 2
+
+LAPLACIAN = np.full((3, 3, 3), -1 / 26)
+LAPLACIAN[1, 1, 1] = 1
+
+
+class Moments:
+    """Count, mean, M2, min and max of the values seen so far."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        n = values.size
+        if n == 0:
+            return
+        mean = np.mean(values, dtype=np.float64)
+        m2 = np.sum(np.square(values - mean, dtype=np.float64))
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    @property
+    def mean_or_fallback(self):
+        return self.mean if self.n else 1e-6
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n) if self.n else 0.0
+
+    @property
+    def var(self):
+        return self.m2 / self.n if self.n else 0.0
+
+    @property
+    def sample_var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+
+class _MedianOfSquares:
+    """Median of the squares of the values seen so far.
+
+    8- and 16-bit integers are counted in a histogram of their values and
+    squared exactly in float64, like the int64 squares of the slice scope;
+    other types are kept until the median is taken.
+    """
+
+    def __init__(self):
+        self.counts = None
+        self.offset = 0
+        self.parts = []
+
+    def add(self, values):
+        if values.dtype.kind in 'iu' and values.dtype.itemsize <= 2:
+            if self.counts is None:
+                info = np.iinfo(values.dtype)
+                self.offset = int(info.min)
+                self.counts = np.zeros(int(info.max) - self.offset + 1, dtype=np.int64)
+            self.counts += np.bincount((values.astype(np.int64) - self.offset).ravel(), minlength=self.counts.size)
+        else:
+            self.parts.append(np.nan_to_num(values, nan=1e-6).ravel())
+
+    def median(self):
+        if self.counts is not None:
+            squares = np.square(np.arange(self.counts.size, dtype=np.float64) + self.offset)
+            order = np.argsort(squares, kind='stable')
+            squares, cumulative = squares[order], np.cumsum(self.counts[order])
+            n = cumulative[-1]
+            if n == 0:
+                return 1e-12
+            lo = squares[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+            hi = squares[np.searchsorted(cumulative, n // 2, side='right')]
+            return (lo + hi) / 2
+        if not self.parts:
+            return 1e-12
+        values = np.concatenate(self.parts)
+        if values.size == 0:
+            return 1e-12
+        return float(np.median(np.square(values.astype(np.float64))))
+
+
+class VolumeStats:
+    """Running statistics of a volume fed chunk by chunk; see the module comment.
+
+    needs holds the optional parts to compute ('laplacian', 'median',
+    'local_variance', 'squares', 'patch'), the moments are always kept.
+    """
+
+    def __init__(self, needs, precision='float64'):
+        self.needs = set(needs)
+        self.float = np.dtype(precision)
+        self.f = Moments()
+        self.b = Moments()
+        self.n_vox = 0
+        self.F_sum = 0.0
+        self.F_squares = 0.0
+        self.F_log = 0.0
+        self.F_max = -np.inf
+        self.laplacian_sum = 0.0
+        self.median_F = 0.0
+        self.median_squares = 0.0
+        self.local_variance_sum = 0.0
+        self.local_variance_count = 0
+        self.f_squares = _MedianOfSquares()
+        self.b_squares = _MedianOfSquares()
+        self.peaks = {}
+
+    def add(self, images, masks, start, stop):
+        """Adds slices start:stop of a chunk whose other slices are context (at most HALO on either side)."""
+        own = slice(start, stop)
+        masks = masks.astype(bool, copy=False)
+        values = np.nan_to_num(images[own].astype(self.float), nan=1e-6)
+        self.f.add(values[masks[own]])
+        self.b.add(values[~masks[own]])
+        self.n_vox += values.size
+
+        F = np.nan_to_num(np.multiply(masks, images, dtype=self.float), nan=1e-6)
+        F_own = F[own]
+        self.F_sum += np.sum(F_own, dtype=np.float64)
+        self.F_squares += np.sum(np.square(F_own), dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.F_log += np.sum(F_own * np.log(F_own + 1e-16), dtype=np.float64)
+        self.F_max = max(self.F_max, float(F_own.max()))
+
+        if 'laplacian' in self.needs:
+            # Zeros beyond the volume, the halo slices elsewhere
+            I_hat = ndi.convolve(F, LAPLACIAN.astype(self.float), mode='constant', cval=0.0)[own]
+            self.laplacian_sum += np.sum(np.nan_to_num(I_hat, nan=1e-6), dtype=np.float64)
+        if 'median' in self.needs:
+            med = ndi.median_filter(F, size=3, mode='nearest')[own].astype(np.float64)
+            self.median_F += np.sum(F_own * med, dtype=np.float64)
+            self.median_squares += np.sum(np.square(med))
+        if 'local_variance' in self.needs:
+            mean = ndi.uniform_filter(F, size=5, mode='constant')
+            mean_sq = ndi.uniform_filter(np.square(F), size=5, mode='constant')
+            local_variance = np.nan_to_num(mean_sq - np.square(mean), nan=1e-6)
+            # windows that lie entirely inside the volume, centred on our own slices
+            z0, z1 = max(start, HALO), min(stop, len(F) - HALO)
+            inner = local_variance[z0:z1, HALO:F.shape[1] - HALO, HALO:F.shape[2] - HALO]
+            self.local_variance_sum += np.sum(inner, dtype=np.float64)
+            self.local_variance_count += inner.size
+        if 'squares' in self.needs:
+            self.f_squares.add(images[own][masks[own]])
+            self.b_squares.add(images[own][~masks[own]])
+        if 'patch' in self.needs:
+            B = np.nan_to_num(np.multiply(~masks, images, dtype=self.float), nan=1e-6)
+            for name, X in (('F', F), ('B', B)):
+                k = int(np.argmax(X[own]))
+                z, y, x = np.unravel_index(k, X[own].shape)
+                value = X[own][z, y, x]
+                # strictly greater: the first maximum of the volume wins
+                if name not in self.peaks or value > self.peaks[name][0]:
+                    self.peaks[name] = (value, _cube(X, start + z, y, x))
+
+    def patch(self, name):
+        return self.peaks[name][1] if name in self.peaks else np.zeros((5, 5, 5))
+
+
+def _cube(X, z, y, x, r=HALO):
+    """The (2r+1)^3 cube of X centred on (z, y, x), zero outside X."""
+    out = np.zeros((2 * r + 1,) * 3, dtype=np.float64)
+    lo = [max(c - r, 0) for c in (z, y, x)]
+    hi = [min(c + r + 1, n) for c, n in zip((z, y, x), X.shape)]
+    out[tuple(slice(l - c + r, h - c + r) for l, h, c in zip(lo, hi, (z, y, x)))] = \
+        X[tuple(slice(l, h) for l, h in zip(lo, hi))]
+    return out
+
+
+def mean(V):
+    return 'MEAN', V.f.mean_or_fallback
+
+
+def rng(V):
+    return 'RNG', V.f.max - V.f.min if V.f.n else 0.0
+
+
+def var(V):
+    return 'VAR', V.f.var
+
+
+def cv(V):
+    m = V.f.mean_or_fallback
+    return 'CV', (V.f.std / m) * 100 if m > 0 else 0
+
+
+def cpp(V):
+    return 'CPP', V.laplacian_sum / V.n_vox
+
+
+def psnr(V):
+    max_val = V.F_max
+    if max_val <= 0:
+        return 'PSNR', 0
+    # mean((F - median(F) / max) ** 2), from sums kept over the chunks
+    mse = (V.F_squares - 2 * V.median_F / max_val + V.median_squares / max_val ** 2) / V.n_vox
+    return 'PSNR', 20 * np.log10(max_val / (np.sqrt(mse) + 1e-9)) if mse > 0 else 0
+
+
+def snr1(V):
+    return 'SNR1', V.f.std / (V.b.std + 1e-9)
+
+
+def snr2(V):
+    return 'SNR2', np.mean(V.patch('F')) / (V.b.std + 1e-9)
+
+
+def snr3(V):
+    fp = V.patch('F')
+    std_diff = np.std(fp - np.mean(fp))
+    return 'SNR3', np.mean(fp) / (std_diff if std_diff > 0 else 1e-9)
+
+
+def snr4(V):
+    bg_std = np.std(V.patch('B'))
+    return 'SNR4', np.mean(V.patch('F')) / (bg_std if bg_std > 0 else 1e-9)
+
+
+def snr5(V):
+    if not V.local_variance_count:
+        return 'SNR5', 0
+    noise_estimate = np.sqrt(max(V.local_variance_sum / V.local_variance_count, 0))
+    return 'SNR5', V.f.mean_or_fallback / (noise_estimate + 1e-9) if noise_estimate > 0 else 0
+
+
+def cnr(V):
+    fp, bp = V.patch('F'), V.patch('B')
+    return 'CNR', np.mean(fp - bp) / (np.std(bp) + 1e-6)
+
+
+def cvp(V):
+    fp = V.patch('F')
+    return 'CVP', np.std(fp) / (np.mean(fp) + 1e-6)
+
+
+def cjv(V):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 'CJV', (V.f.std + V.b.std) / abs(V.f.mean_or_fallback - V.b.mean_or_fallback)
+
+
+def efc(V):
+    n_vox = V.n_vox
+    if n_vox == 0:
+        return 'EFC', 0
+    efc_max = 1.0 * n_vox * (1.0 / np.sqrt(n_vox)) * np.log(1.0 / np.sqrt(n_vox))
+    b_max = np.sqrt(V.F_squares) if V.F_squares > 0 else 1e-6
+    # sum((F / b_max) * log((F + 1e-16) / b_max)) from sum(F log(F + 1e-16)) and sum(F)
+    return 'EFC', (1.0 / abs(efc_max)) * (V.F_log - np.log(b_max) * V.F_sum) / b_max
+
+
+def fber(V):
+    fg_mu = V.f_squares.median()
+    bg_mu = V.b_squares.median()
+    return 'FBER', fg_mu / (bg_mu + 1e-6) if bg_mu > 1.0e-3 else 0
+
+
+# The optional parts of VolumeStats each metric reads.
+NEEDS = {cpp: 'laplacian', psnr: 'median', snr5: 'local_variance', fber: 'squares',
+         snr2: 'patch', snr3: 'patch', snr4: 'patch', cnr: 'patch', cvp: 'patch'}
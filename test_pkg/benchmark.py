@@ -0,0 +1,249 @@
+"""Per-stage timings of the RadQy pipeline on a synthetic phantom corpus.
+
+Writes a phantom corpus (phantoms.py), runs each stage of the pipeline on
+it separately and writes the timings as JSON:
+
+    python benchmark.py --out bench.json --size 256 --slices 40
+
+Stages, per input format:
+
+- input_data: discovery and grouping of the whole corpus folder
+- volume: volume() plus decoding the sampled slices
+- extract_tags: TagPlan.extract on the header of the participant
+- foreground: IQM.foreground on every sampled slice
+- funcN: each metric function on every sampled slice, with a fresh
+  SliceContext per call so the foreground work it needs is included
+- stack_metrics: the batched metrics of the whole sampled stack
+- save_image: one thumbnail PNG per sampled slice
+- IQM: the whole participant (volume, masks, metrics, thumbnails)
+- worker_callback: ResultWriter.write of the participant's row
+
+Every stage is repeated --repeat times; the JSON keeps the calls, total,
+mean, median, min and max in seconds of each.
+
+For every tolerance of --adaptive (default 0.05,0.1) each participant is
+also scored with `radqy --adaptive`; the 'adaptive' records keep the
+slices used out of the candidates and the largest relative difference of
+the tested metric means from those of every candidate slice.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import radqy
+from radqy import radqy as rq
+from radqy.sampling import DEFAULT_METRICS
+from radqy.tags import TagPlan
+from radqy.thumbnails import write_thumbnail
+from phantoms import FORMATS, make_corpus
+
+
+class Timer:
+    """Collects the durations of repeated calls, by format and stage."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, fmt, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault((fmt, stage), []).append(time.perf_counter() - start)
+        return result
+
+    def error(self, fmt, stage, exc):
+        self.samples.setdefault((fmt, stage), exc)
+
+    def records(self):
+        records = []
+        for (fmt, stage), samples in self.samples.items():
+            if isinstance(samples, Exception):
+                records.append({'format': fmt, 'stage': stage, 'error': f'{type(samples).__name__}: {samples}'})
+                continue
+            samples = np.asarray(samples)
+            records.append({'format': fmt, 'stage': stage, 'calls': len(samples), 'total_s': samples.sum(),
+                            'mean_s': samples.mean(), 'median_s': float(np.median(samples)),
+                            'min_s': samples.min(), 'max_s': samples.max()})
+        return [{k: float(v) if isinstance(v, np.floating) else v for k, v in r.items()} for r in records]
+
+
+def tag_header(path, subject_type, tag_plan):
+    if subject_type == 'dicom':
+        import pydicom
+        return pydicom.dcmread(path[0], stop_before_pixels=True, specific_tags=tag_plan.dicom_tags)
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def load_sampled(name, scans, subject_type, tag_plan, settings):
+    v = rq.volume(name, scans, subject_type, tag_plan, settings['middle_size'])
+    images = v[0][0] if isinstance(v[0], tuple) else v[0]
+    return np.stack([images[j] for j in range(0, images.shape[0], settings['sample_size'])])
+
+
+def bench_participant(timer, fmt, row, i, total, tag_plan, functions, settings, writer, repeat):
+    name, scans, subject_type = row['subject_id'], row['path'], row['subject_type']
+    for _ in range(repeat):
+        sampled = timer.time(fmt, 'volume', load_sampled, name, scans, subject_type, tag_plan, settings)
+    header = tag_header(scans, subject_type, tag_plan)
+    for _ in range(repeat):
+        tags = timer.time(fmt, 'extract_tags', tag_plan.extract, header, subject_type)
+
+    masks = np.empty(sampled.shape, dtype=bool)
+    for _ in range(repeat):
+        for k, I in enumerate(sampled):
+            masks[k] = timer.time(fmt, 'foreground', rq.IQM.foreground, None, rq.widen(I))[2]
+    for func in functions:
+        for _ in range(repeat):
+            for k, I in enumerate(sampled):
+                ctx = rq.SliceContext.from_mask(rq.widen(I), masks[k])
+                timer.time(fmt, func.__name__, rq.call_metric, func, ctx)
+    for _ in range(repeat):
+        timer.time(fmt, 'stack_metrics', rq.stack_metrics, sampled, masks, functions)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for _ in range(repeat):
+            for k, I in enumerate(sampled):
+                timer.time(fmt, 'save_image', write_thumbnail, Path(folder) / f'{k}.png', I)
+
+    for _ in range(repeat):
+        s = timer.time(fmt, 'IQM', rq.process_participant, i + 1, total, name, scans, subject_type,
+                       tag_plan, len(tags), functions, settings)
+    for _ in range(repeat):
+        timer.time(fmt, 'worker_callback', writer.write, writer.next_index, s)
+    return s
+
+
+def bench_adaptive(fmt, row, i, total, tag_plan, functions, settings, full, tolerances):
+    """Slices used by --adaptive at each tolerance, and the error of the metric means against the full run."""
+    name, scans, subject_type = row['subject_id'], row['path'], row['subject_type']
+    means = {k: np.mean(v) for k, v in full['slice_metrics'].items() if k != 'Slice'}
+    records = []
+    for tolerance in tolerances:
+        s = rq.process_participant(i + 1, total, name, scans, subject_type, tag_plan, 0, functions,
+                                   {**settings, 'adaptive': tolerance})
+        errors = [abs(np.mean(s['slice_metrics'][k]) / means[k] - 1) for k in DEFAULT_METRICS
+                  if k in means and np.isfinite(means[k]) and means[k] != 0]
+        records.append({'format': fmt, 'subject': name, 'tolerance': tolerance,
+                        'slices': s['participant_scan_number'], 'candidates': full['participant_scan_number'],
+                        'max_error': float(max(errors)) if errors else None})
+    return records
+
+
+def run(args):
+    workdir = Path(args.corpus or tempfile.mkdtemp(prefix='radqy_bench_'))
+    formats = args.formats.split(',')
+    timer = Timer()
+    tolerances = [float(t) for t in args.adaptive.split(',')] if args.adaptive else []
+    adaptive = []
+    try:
+        corpus = make_corpus(workdir / 'corpus', formats, args.subjects, args.slices, args.size,
+                             args.noise, args.seed, args.gzip)
+        outdir = workdir / 'output'
+        settings = {'fname_outdir': outdir, 'sample_size': args.b, 'middle_size': args.u, 'scan_type': 'MRI',
+                    'save_masks_flag': False, 'precision': 'float64', 'thumb_size': None, 'thumb_layout': 'files'}
+        tag_path = Path(rq.__file__).parent / 'MRI_TAGS.yaml'
+        with open(tag_path, 'rb') as file:
+            tag_plan = TagPlan(yaml.safe_load(file))
+        functions = rq.metric_functions()
+        outdir.mkdir(parents=True, exist_ok=True)
+        writer = rq.ResultWriter(outdir / 'results.tsv', [], ordered=False)
+
+        # RadQy reports every participant and metric on stdout
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            for fmt in formats:
+                folder = str(workdir / 'corpus' / fmt)
+                for _ in range(args.repeat):
+                    df = timer.time(fmt, 'input_data', rq.input_data, folder, 16, None)
+                for i in range(len(df)):
+                    try:
+                        full = bench_participant(timer, fmt, df.iloc[i], i, len(df), tag_plan, functions,
+                                                 settings, writer, args.repeat)
+                        adaptive += bench_adaptive(fmt, df.iloc[i], i, len(df), tag_plan, functions,
+                                                   settings, full, tolerances)
+                    except Exception as exc:
+                        # e.g. a format the pipeline cannot read; keep the stages that did run
+                        timer.error(fmt, 'participant', exc)
+        writer.close()
+    finally:
+        if not args.corpus:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'radqy_version': getattr(radqy, '__version__', None) or _version(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'formats': formats, 'subjects': args.subjects, 'slices': args.slices, 'size': args.size,
+                   'noise': args.noise, 'seed': args.seed, 'gzip': args.gzip, 'repeat': args.repeat,
+                   'sample_size': args.b, 'middle_size': args.u, 'adaptive': tolerances},
+        'corpus': corpus,
+        'stages': timer.records(),
+        'adaptive': adaptive,
+    }
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('radqy')
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the RadQy pipeline stages on synthetic phantoms.')
+    parser.add_argument('--out', default='bench.json', help="JSON file for the results ('-' for stdout)")
+    parser.add_argument('--formats', default=','.join(FORMATS), help="comma separated subset of " + ', '.join(FORMATS))
+    parser.add_argument('--subjects', type=int, default=2, help="phantoms per format")
+    parser.add_argument('--slices', type=int, default=40)
+    parser.add_argument('--size', type=int, default=256, help="matrix size of every slice")
+    parser.add_argument('--noise', type=float, default=0.05, help="noise std as a fraction of the tissue level")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true', help="write .nii.gz instead of .nii")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every stage")
+    parser.add_argument('-b', type=int, default=1, help="sample every b-th slice, as radqy -b")
+    parser.add_argument('-u', type=int, default=100, help="percent of middle slices, as radqy -u")
+    parser.add_argument('--adaptive', default='0.05,0.1',
+                        help="comma separated --adaptive tolerances to report the slices used for ('' for none)")
+    parser.add_argument('--corpus', default=None, help="keep the corpus and outputs in this folder")
+    parser.add_argument('--verbose', action='store_true', help="show RadQy's own output")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=1)
+    if args.out == '-':
+        print(text)
+    else:
+        Path(args.out).write_text(text)
+        for r in report['stages']:
+            if 'error' in r:
+                print(f"{r['format']:>6} {r['stage']:<16} {r['error']}")
+            else:
+                print(f"{r['format']:>6} {r['stage']:<16} {r['calls']:>6} calls  {r['mean_s'] * 1e3:10.3f} ms mean")
+        for r in report['adaptive']:
+            print(f"{r['format']:>6} {r['subject']:<16} --adaptive {r['tolerance']:<5} "
+                  f"{r['slices']:>4} of {r['candidates']} slices, max error {r['max_error']:.3f}")
+        print(f"Timings written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
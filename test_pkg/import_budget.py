@@ -0,0 +1,95 @@
+"""Checks that `radqy --help` starts fast and loads no scientific library.
+
+Runs `radqy --help` in fresh interpreters, takes the median wall time
+minus that of an empty interpreter and fails (exit status 1) when it is
+over the budget, or when any of HEAVY_MODULES was imported:
+
+    python import_budget.py --budget 0.15 --api-budget 1.0 --runs 7
+
+`import radqy.api` is measured the same way against --api-budget. It does
+load the libraries of the metrics (API_MODULES): compute_iqms needs them on
+its first call, and they cost about 0.8 s on a single core, 0.65 s of it
+scipy.signal (for convolve2d), which loads scipy.stats. It fails when it
+loads any other of HEAVY_MODULES (pandas, SimpleITK, pydicom, ...), which
+only the file reading and result writing of the command line need.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = str(Path(__file__).resolve().parent.parent)
+
+# Libraries that only the scoring code paths may import.
+HEAVY_MODULES = ['numpy', 'scipy', 'skimage', 'pandas', 'SimpleITK', 'pydicom', 'matplotlib', 'yaml', 'pyarrow']
+
+HELP = ("import sys; sys.argv = ['radqy', '--help']\n"
+        "from radqy.cli import run_cli\n"
+        "try:\n    run_cli()\nexcept SystemExit:\n    pass\n")
+
+# Libraries `import radqy.api` may load.
+API_MODULES = ['numpy', 'scipy', 'skimage', 'yaml']
+
+API = "import sys\nimport radqy.api\n"
+
+REPORT = f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules), file=sys.stderr)\n"
+LOADED = HELP + REPORT
+
+
+def run(code):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result
+
+
+def median_time(code, runs):
+    return statistics.median(run(code)[0] for _ in range(runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time budget of the radqy command line.')
+    parser.add_argument('--budget', type=float, default=0.15, help="seconds `radqy --help` may add to interpreter startup")
+    parser.add_argument('--api-budget', type=float, default=1.0, help="seconds `import radqy.api` may add to interpreter startup")
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--json', default=None, help="also write the measurements to this file")
+    args = parser.parse_args()
+
+    baseline = median_time('pass', args.runs)
+    help_time = median_time(HELP, args.runs)
+    loaded = [m for m in run(LOADED)[1].stderr.strip().split(',') if m]
+    overhead = help_time - baseline
+    api_time = median_time(API, args.runs)
+    api_loaded = [m for m in run(API + REPORT)[1].stderr.strip().split(',') if m]
+    api_overhead = api_time - baseline
+    report = {'python': sys.version.split()[0], 'runs': args.runs, 'interpreter_s': baseline,
+              'help_s': help_time, 'overhead_s': overhead, 'budget_s': args.budget, 'heavy_modules': loaded,
+              'api_s': api_time, 'api_overhead_s': api_overhead, 'api_budget_s': args.api_budget,
+              'api_modules': api_loaded}
+    print(f"interpreter {baseline * 1e3:.1f} ms, radqy --help {help_time * 1e3:.1f} ms, "
+          f"overhead {overhead * 1e3:.1f} ms (budget {args.budget * 1e3:.0f} ms)")
+    print(f"import radqy.api {api_time * 1e3:.1f} ms, overhead {api_overhead * 1e3:.1f} ms "
+          f"(budget {args.api_budget * 1e3:.0f} ms), loads {', '.join(api_loaded) or 'none'}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=1))
+    failed = False
+    if loaded:
+        print(f"radqy --help imported {', '.join(loaded)}")
+        failed = True
+    if overhead > args.budget:
+        print("radqy --help is over its import-time budget")
+        failed = True
+    extra = [m for m in api_loaded if m not in API_MODULES]
+    if extra:
+        print(f"import radqy.api imported {', '.join(extra)}")
+        failed = True
+    if api_overhead > args.api_budget:
+        print("import radqy.api is over its import-time budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
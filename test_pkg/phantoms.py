@@ -0,0 +1,130 @@
+"""Deterministic synthetic volumes for the RadQy benchmarks.
+
+Every phantom is an ellipsoid of tissue with a smooth intensity ripple on a
+dark background, plus Gaussian noise; the same seed gives the same voxels.
+make_corpus writes them as DICOM series, NIfTI, MHA and MAT files in the
+folder layout input_data expects.
+"""
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+
+FORMATS = ('dicom', 'nifti', 'mha', 'mat')
+
+
+def phantom(n_slices, size, noise=0.05, seed=0):
+    """A (n_slices, size, size) uint16 volume; noise is the noise std as a fraction of the tissue level."""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[:n_slices, :size, :size]
+    r = (((y - size / 2) / (size * 0.35)) ** 2 + ((x - size / 2) / (size * 0.3)) ** 2
+         + ((z - n_slices / 2) / (n_slices * 0.6)) ** 2)
+    tissue = 800 + 200 * np.sin(x / (size / 10)) * np.cos(z / max(n_slices / 6, 1))
+    v = np.where(r < 1, tissue, 40.0) + rng.normal(0, noise * 800, (n_slices, size, size))
+    return np.clip(v, 0, 65535).astype(np.uint16)
+
+
+def write_dicom(folder, volume, subject, spacing=(1.0, 1.0, 2.5)):
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    series_uid = generate_uid(entropy_srcs=[subject, 'series'])
+    for i, pixels in enumerate(volume):
+        meta = FileMetaDataset()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=[subject, str(i)])
+        ds = Dataset()
+        ds.file_meta = meta
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.PatientID = subject
+        ds.StudyInstanceUID = series_uid + '.1'
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = i + 1
+        ds.Modality = 'MR'
+        ds.Manufacturer = 'PHANTOM'
+        ds.RepetitionTime = 500
+        ds.EchoTime = 10
+        ds.Rows, ds.Columns = pixels.shape
+        ds.PixelSpacing = [spacing[0], spacing[1]]
+        ds.SliceThickness = spacing[2]
+        ds.ImagePositionPatient = [0, 0, spacing[2] * i]
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelData = pixels.tobytes()
+        path = folder / f'IM{i:04d}.dcm'
+        if int(pydicom.__version__.split('.')[0]) >= 3:
+            ds.save_as(path, enforce_file_format=True)
+        else:
+            ds.is_little_endian, ds.is_implicit_VR = True, False
+            ds.save_as(path, write_like_original=False)
+
+
+def write_sitk(path, volume, spacing=(1.0, 1.0, 2.5)):
+    import SimpleITK as sitk
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing(spacing)
+    sitk.WriteImage(image, str(path))
+
+
+def write_mat(path, volume):
+    from scipy.io import savemat
+
+    # RadQy reads MAT volumes from the 'vol' variable, (H, W, n_slices)
+    savemat(str(path), {'vol': np.transpose(volume, (1, 2, 0))})
+
+
+def make_corpus(root, formats=FORMATS, subjects=2, slices=40, size=256, noise=0.05, seed=0, gzip=False):
+    """Writes subjects phantoms per format under root/<format>/ and returns the list of what was written."""
+    root = Path(root)
+    corpus = []
+    for f, fmt in enumerate(formats):
+        folder = root / fmt
+        folder.mkdir(parents=True, exist_ok=True)
+        for k in range(subjects):
+            subject = f'{fmt}{k:03d}'
+            volume = phantom(slices, size, noise, seed + 1000 * f + k)
+            if fmt == 'dicom':
+                path = folder / subject
+                write_dicom(path, volume, subject)
+            elif fmt == 'nifti':
+                path = folder / (subject + ('.nii.gz' if gzip else '.nii'))
+                write_sitk(path, volume)
+            elif fmt == 'mha':
+                path = folder / (subject + '.mha')
+                write_sitk(path, volume)
+            elif fmt == 'mat':
+                path = folder / (subject + '.mat')
+                write_mat(path, volume)
+            else:
+                raise ValueError(f"Unknown phantom format: {fmt}")
+            corpus.append({'format': fmt, 'subject': subject, 'path': str(path),
+                           'shape': list(volume.shape), 'noise': noise})
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic phantom corpus.')
+    parser.add_argument('root', help="output folder, one subfolder per format")
+    parser.add_argument('--formats', default=','.join(FORMATS), help="comma separated subset of " + ', '.join(FORMATS))
+    parser.add_argument('--subjects', type=int, default=2, help="phantoms per format")
+    parser.add_argument('--slices', type=int, default=40)
+    parser.add_argument('--size', type=int, default=256, help="matrix size of every slice")
+    parser.add_argument('--noise', type=float, default=0.05, help="noise std as a fraction of the tissue level")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true', help="write .nii.gz instead of .nii")
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    for entry in make_corpus(args.root, args.formats.split(','), args.subjects, args.slices,
+                             args.size, args.noise, args.seed, args.gzip):
+        print(entry['path'])
@@ -0,0 +1,58 @@
+"""Copies a folder of studies into a watched folder the way a scanner export does.
+
+Files arrive one at a time, each written in chunks, with a pause between
+files and a longer one between series (folders), so `radqy serve` sees
+partial files and partial series:
+
+    radqy serve live --watch /tmp/inbox --quiescence 2 --idle-exit 10 &
+    python simulate_arrivals.py corpus/ /tmp/inbox --interval 0.05 --series-gap 3
+
+The files get new modification times, which serve_log.jsonl reports as
+their arrival times.
+"""
+import argparse
+import os
+import time
+from pathlib import Path
+
+
+def copy_slowly(src, dst, chunk_size=65536, chunk_delay=0.0):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while True:
+            chunk = fin.read(chunk_size)
+            if not chunk:
+                break
+            fout.write(chunk)
+            fout.flush()
+            if chunk_delay:
+                time.sleep(chunk_delay)
+
+
+def simulate(source, target, interval=0.05, series_gap=2.0, chunk_size=65536, chunk_delay=0.0):
+    source, target = Path(source), Path(target)
+    folders = sorted({Path(dirpath) for dirpath, _, filenames in os.walk(source) if filenames})
+    start = time.time()
+    copied = 0
+    for k, folder in enumerate(folders):
+        if k:
+            time.sleep(series_gap)
+        for path in sorted(p for p in folder.iterdir() if p.is_file()):
+            copy_slowly(path, target / path.relative_to(source), chunk_size, chunk_delay)
+            copied += 1
+            time.sleep(interval)
+        print(f"{time.time() - start:8.2f}s  {folder.relative_to(source)} copied")
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy studies into a watched folder file by file.')
+    parser.add_argument('source', help="folder of studies to copy")
+    parser.add_argument('target', help="watched folder")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between files")
+    parser.add_argument('--series-gap', type=float, default=2.0, help="seconds between folders")
+    parser.add_argument('--chunk-size', type=int, default=65536, help="bytes written at a time")
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between chunks of a file")
+    args = parser.parse_args()
+    n = simulate(args.source, args.target, args.interval, args.series_gap, args.chunk_size, args.chunk_delay)
+    print(f"{n} files copied to {args.target}")